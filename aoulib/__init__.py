@@ -1,6 +1,43 @@
-import hy
-from .core import *
-from . import transform
-from . import etl
-from . import managekeys
+'''
+Submodules are imported on first use (e.g. aoulib.etl, aou.managekeys),
+so a script that only cycles keys doesn't load Hy, pytds, etc. The names
+defined in core (get_records, iter_pages, ...) can still be used from the
+package itself; the first such use imports core.
+'''
+import sys
+import importlib
 
+_SUBMODULES = {'core', 'transform', 'etl', 'fetch', 'pagecache', 'metrics',
+               'profiling', 'managekeys', 'db', 'utils',
+               'active_retention_date'}
+
+class _HyFinder:
+  '''Imports hy, which registers the importer for .hy files, just before
+  core.hy is first imported (by whatever route).'''
+  @staticmethod
+  def find_spec(fullname, path=None, target=None):
+    if fullname == __name__ + '.core' and 'hy' not in sys.modules:
+      import hy
+    # Let the regular finders (now including hy's) do the work.
+    return None
+
+sys.meta_path.insert(0, _HyFinder)
+
+def _core():
+  return importlib.import_module('.core', __name__)
+
+def __getattr__(name):
+  if name == 'core':
+    return _core()
+  if name in _SUBMODULES:
+    return importlib.import_module('.' + name, __name__)
+  if name.startswith('__'):
+    raise AttributeError(name)
+  try:
+    return getattr(_core(), name)
+  except AttributeError:
+    raise AttributeError('module {!r} has no attribute {!r}'
+                         ''.format(__name__, name)) from None
+
+def __dir__():
+  return sorted(set(globals()) | _SUBMODULES)
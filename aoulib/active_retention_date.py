@@ -1,15 +1,140 @@
+import re
 import datetime
-from dateutil import parser
+import functools
 from .db import *
 
 COLUMN_NAME = 'Active Retention Date'
 
+# Column definition, shaped like db_get_table_info's results.
+COLUMN_INFO = {'column_name': COLUMN_NAME,
+               'data_type': 'nvarchar',
+               'character_maximum_length': 32,
+               'is_nullable': 'YES'}
+
+# Number of days back (from today, inclusive) that count as active.
+WINDOW_DAYS = 547
+
+# Rules for the dates that count toward Active Retention; each one names a
+# HealthPro date column, optionally the completion flag column that must be
+# '1' for it to count, and optionally the Consent Cohort values it applies
+# to. A new survey is one more entry here.
+RULES = [
+    # PPI4 - Healthcare Access PPI Module
+    {'date': 'Access PPI Survey Completion Date',
+     'flag': 'Access PPI Survey Complete'},
+    # Family Health PPI Module
+    {'date': 'Family PPI Survey Completion Date',
+     'flag': 'Family PPI Survey Complete'},
+    # PPI6 - Medical History PPI Module
+    {'date': 'Hist PPI Survey Completion Date',
+     'flag': 'Hist PPI Survey Complete'},
+    # PPI7 - COPE PPI
+    {'date': 'COPE May PPI Survey Completion Date',
+     'flag': 'COPE May PPI Survey Complete'},
+    {'date': 'COPE June PPI Survey Completion Date',
+     'flag': 'COPE June PPI Survey Complete'},
+    {'date': 'COPE July PPI Survey Completion Date',
+     'flag': 'COPE July PPI Survey Complete'},
+    {'date': 'COPE Nov PPI Survey Completion Date',
+     'flag': 'COPE Nov PPI Survey Complete'},
+    {'date': 'COPE Dec PPI Survey Completion Date',
+     'flag': 'COPE Dec PPI Survey Complete'},
+    {'date': 'COPE Feb PPI Survey Completion Date',
+     'flag': 'COPE Feb PPI Survey Complete'},
+    # Summer and Fall Survey
+    {'date': 'Summer Meeting Survey Complete Date',
+     'flag': 'Summer Meeting Survey Complete'},
+    {'date': 'Fall Meeting Survey Complete Date',
+     'flag': 'Fall Meeting Survey Complete'},
+    # P&F Hx, Winter Minute, and New Year Minute Survey
+    {'date': 'Personal & Family Hx PPI Survey Completion Date',
+     'flag': 'Personal & Family Hx PPI Survey Complete'},
+    {'date': 'Winter Minute PPI Survey Completion Date',
+     'flag': 'Winter Minute PPI Survey Complete'},
+    {'date': 'New Year Minute PPI Survey Completion Date',
+     'flag': 'New Year Minute PPI Survey Complete'},
+    # Consents
+    {'date': 'gRoR Consent Date',
+     'cohorts': ['Cohort 1', 'Cohort 2', 'Cohort 2 Pilot']},
+    {'date': 'General Consent Date',
+     'flag': 'General Consent Status',
+     'cohorts': ['Cohort 1']},
+]
+
+STATUS_COLUMN = 'retentionEligibleStatus'
+COHORT_COLUMN = 'Consent Cohort'
+
+# HealthPro columns that calc_val reads.
+INPUT_COLUMNS = ([STATUS_COLUMN]
+                 + [col for rule in RULES
+                    for col in (rule.get('flag'), rule['date']) if col]
+                 + [COHORT_COLUMN])
+
+# Date columns hold HealthPro-formatted values ('mm/dd/yyyy[ hh:mm AM]')
+# when freshly transformed, or 'yyyy-mm-dd[ hh:mm:ss]' when read back
+# from the table (see refresh_column).
+_hp_date_re = re.compile(r'(\d\d)/(\d\d)/(\d{4})(?: \d\d:\d\d [AP]M)?$')
+_iso_date_re = re.compile(r'(\d{4})-(\d\d)-(\d\d)(?:[ T][\d:.]+)?$')
+
+BLANK_DATE = datetime.date(1900, 1, 1)
+
+@functools.lru_cache(maxsize=65536)
+def _parse_date(x):
+    m = _hp_date_re.match(x)
+    if m:
+        return datetime.date(int(m.group(3)), int(m.group(1)), int(m.group(2)))
+    m = _iso_date_re.match(x)
+    if m:
+        return datetime.date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+    from dateutil import parser
+    return parser.parse(x).date()
+
 def str2date(x):
     if x.strip() == '':
-        x = '1900-01-01'
-    return parser.parse(x).date()
+        return BLANK_DATE
+    return _parse_date(x)
+
+def window_start(today=None):
+    '''Earliest date that counts as active: WINDOW_DAYS before today.'''
+    today = today or datetime.date.today()
+    return today - datetime.timedelta(days=WINDOW_DAYS)
+
+def _compile_rules(rules):
+    return [(rule['date'], rule.get('flag'),
+             frozenset(rule['cohorts']) if rule.get('cohorts') else None)
+            for rule in rules]
+
+def _earliest(rcd, rules, begin_dt):
+    if rcd[STATUS_COLUMN] != 'ELIGIBLE':
+        return ''
+    cohort = rcd[COHORT_COLUMN]
+    earliest = None
+    for date_col, flag_col, cohorts in rules:
+        if flag_col is not None and rcd[flag_col] != '1':
+            continue
+        if cohorts is not None and cohort not in cohorts:
+            continue
+        x = rcd[date_col]
+        # Blank dates (BLANK_DATE) are never in the window.
+        if not x or x.isspace():
+            continue
+        dt = _parse_date(x)
+        if dt >= begin_dt and (earliest is None or dt < earliest):
+            earliest = dt
+    return earliest.strftime('%Y-%m-%d') if earliest else ''
+
+def calc_vals(rcds, begin_dt=None):
+    '''
+    calc_val for a batch of rows; returns a list of values in the same
+    order. begin_dt (see window_start) defaults to the one for today; pass
+    it in to use the same window for every batch of a run.
+    '''
+    if begin_dt is None:
+        begin_dt = window_start()
+    rules = _compile_rules(RULES)
+    return [_earliest(rcd, rules, begin_dt) for rcd in rcds]
 
-def calc_val(rcd):
+def calc_val(rcd, begin_dt=None):
     '''
     Returns either:
       * a string containing a date representation formatted like 'YYYY-MM-DD'.
@@ -17,115 +142,18 @@ def calc_val(rcd):
 
     1) Filter for Active Retention.
 
-    2) Collect pertinent dates between
-    547 days ago and today, inclusive for fields of interest, and return the
-    the **earliest date** amongst those dates collected; or...
+    2) Collect pertinent dates (see RULES) between begin_dt (547 days ago
+    by default) and today, inclusive, and return the **earliest date**
+    amongst those dates collected; or...
 
     3) if none found, empty string will be returned. 
 
+    Dates are only parsed for ELIGIBLE rows whose rule applies.
+
     See Nexus/Jira for additional info.
     https://nexus.weill.cornell.edu/display/ARCH/AoU+Active+Retention+Date
     '''
-
-    retention_status    = rcd['retentionEligibleStatus']
-    # PPI4 - Healthcare Access PPI Module
-    access_ppi          = rcd['Access PPI Survey Complete']
-    access_ppi_dt       = str2date(rcd['Access PPI Survey Completion Date'])
-    # Family Health PPI Module
-    fam_ppi             = rcd['Family PPI Survey Complete']
-    fam_ppi_dt          = str2date(rcd['Family PPI Survey Completion Date'])
-    # PPI6 - Medical History PPI Module 
-    hist_ppi            = rcd['Hist PPI Survey Complete']
-    hist_ppi_dt         = str2date(rcd['Hist PPI Survey Completion Date'])
-    # PPI7 - COPE PPI
-    cope_may        = rcd['COPE May PPI Survey Complete']
-    cope_may_dt     = str2date(rcd['COPE May PPI Survey Completion Date'])
-    cope_june       = rcd['COPE June PPI Survey Complete']
-    cope_june_dt    = str2date(rcd['COPE June PPI Survey Completion Date'])
-    cope_july       = rcd['COPE July PPI Survey Complete']
-    cope_july_dt    = str2date(rcd['COPE July PPI Survey Completion Date'])
-    cope_nov       = rcd['COPE Nov PPI Survey Complete']
-    cope_nov_dt    = str2date(rcd['COPE Nov PPI Survey Completion Date'])
-    cope_dec       = rcd['COPE Dec PPI Survey Complete']
-    cope_dec_dt    = str2date(rcd['COPE Dec PPI Survey Completion Date'])
-    cope_feb       = rcd['COPE Feb PPI Survey Complete']
-    cope_feb_dt    = str2date(rcd['COPE Feb PPI Survey Completion Date'])
-    # Summer and Fall Survey
-    summer_survey       = rcd['Summer Meeting Survey Complete']
-    summer_survey_dt    = str2date(rcd['Summer Meeting Survey Complete Date'])
-    fall_survey         = rcd['Fall Meeting Survey Complete']
-    fall_survey_dt      = str2date(rcd['Fall Meeting Survey Complete Date'])
-    # P&F Hx, Winter Minute, and New Year Minute Survey
-    pfhx_survey         = rcd['Personal & Family Hx PPI Survey Complete']
-    pfhx_survey_dt      = str2date(rcd['Personal & Family Hx PPI Survey Completion Date'])
-    winter_survey       = rcd['Winter Minute PPI Survey Complete']
-    winter_survey_dt    =str2date(rcd['Winter Minute PPI Survey Completion Date'])
-    newyear_survey       = rcd['New Year Minute PPI Survey Complete']
-    newyear_survey_dt    =str2date(rcd['New Year Minute PPI Survey Completion Date'])
-
-    gror_consent_dt = str2date(rcd['gRoR Consent Date'])
-
-    general_consent_status = rcd['General Consent Status']
-    general_consent_dt = str2date(rcd['General Consent Date'])
-
-    consent_cohort = rcd['Consent Cohort']
-
-    # Determine what date 547 days ago was.
-    begin_dt = datetime.datetime.now().date() - datetime.timedelta(days=547)
-
-    # List of potential return values; we'll resolve to
-    # one of these to return (if any).
-    potentials = []
-
-    # 1) Find all pertinent dates.
-    if retention_status == 'ELIGIBLE':
-        if (access_ppi == '1' and access_ppi_dt >= begin_dt):
-            potentials.append(access_ppi_dt)
-        if (fam_ppi == '1' and fam_ppi_dt >= begin_dt):
-            potentials.append(fam_ppi_dt)
-        if (hist_ppi == '1' and hist_ppi_dt >= begin_dt):
-            potentials.append(hist_ppi_dt)
-        if (cope_may == '1' and cope_may_dt >= begin_dt):
-            potentials.append(cope_may_dt)
-        if (cope_june == '1' and cope_june_dt >= begin_dt):
-            potentials.append(cope_june_dt)
-        if (cope_july == '1' and cope_july_dt >= begin_dt):
-            potentials.append(cope_july_dt)
-        if (cope_nov == '1' and cope_nov_dt >= begin_dt):
-            potentials.append(cope_nov_dt)
-        if (cope_dec == '1' and cope_dec_dt >= begin_dt):
-            potentials.append(cope_dec_dt)
-        if (cope_feb == '1' and cope_feb_dt >= begin_dt):
-            potentials.append(cope_feb_dt)
-        if (summer_survey == '1' and summer_survey_dt >= begin_dt):
-            potentials.append(summer_survey_dt)
-        if (fall_survey == '1' and fall_survey_dt >= begin_dt):
-            potentials.append(fall_survey_dt)
-        if (pfhx_survey == '1' and pfhx_survey_dt >= begin_dt):
-            potentials.append(pfhx_survey_dt)
-        if (winter_survey == '1' and winter_survey_dt >= begin_dt):
-            potentials.append(winter_survey_dt)
-        if (newyear_survey == '1' and newyear_survey_dt >= begin_dt):
-            potentials.append(newyear_survey_dt)
-        if (gror_consent_dt >= begin_dt
-            and consent_cohort in ['Cohort 1', 'Cohort 2', 'Cohort 2 Pilot']):
-            potentials.append(gror_consent_dt)
-        if (general_consent_status == '1'
-            and general_consent_dt >= begin_dt
-            and consent_cohort == 'Cohort 1'):
-            potentials.append(general_consent_dt)
-
-    # At this point return empty string if no pertinent dates.
-    if potentials == []: return ''
-
-    # 2) determine which date.
-    out = min(potentials)
-
-    # 3) convert into required str format.
-    out = out.strftime("%Y-%m-%d")
-
-    # All set; return prepped string. 
-    return out
+    return calc_vals([rcd], begin_dt)[0]
 
 #------------------------------------------------------------------------------
 # db 
@@ -135,7 +163,8 @@ def add_column_if_needed(db_spec, db_table_name):
     Get column names.
     If 'Active Retention Date' isn't there, add it to the table.
     '''
-    catalog, schema, table = db_table_name.split('.')
+    catalog, schema, table = [part.replace('[', '').replace(']', '')
+                              for part in db_table_name.split('.')]
     # Add 'database' key to db_spec just in case; needed for operations here.
     db_spec = db_spec.copy()
     db_spec['database'] = catalog
@@ -144,7 +173,30 @@ def add_column_if_needed(db_spec, db_table_name):
             for row in db_get_table_info(db_spec, schema, table)]
     if COLUMN_NAME not in cols:
         # Column doesn't exist; add it.
-        stmt = ('alter table [{}].[{}] add [{}] [nvarchar](32) NULL'
-                ''.format(schema, table, COLUMN_NAME))
+        stmt = ('alter table [{}].[{}] add [{}] [nvarchar]({}) NULL'
+                ''.format(schema, table, COLUMN_NAME,
+                          COLUMN_INFO['character_maximum_length']))
         db_stmt(db_spec, stmt)
 
+def refresh_column(db_spec, db_table_name, begin_dt=None):
+    '''
+    Recalculate Active Retention Date for the rows already in the table and
+    update the ones whose value changed. The value depends on today's date,
+    so rows that were not reloaded (e.g., after an incremental refresh)
+    still need this. Returns the number of rows updated.
+    '''
+    # Dates come back as 'yyyy-mm-dd[ hh:mi:ss]' strings, which str2date
+    # handles; NULLs become blanks like in freshly transformed rows.
+    cols = ', '.join("isnull(convert(nvarchar(64), [{0}], 120), '') as [{0}]"
+                     "".format(col) for col in INPUT_COLUMNS)
+    qy = ('select [PMI ID] as pmi_id, [{}] as current_val, {} from {}'
+          ''.format(COLUMN_NAME, cols, db_table_name))
+    rows = db_qy(db_spec, qy)
+    updates = [(val, row['pmi_id'])
+               for row, val in zip(rows, calc_vals(rows, begin_dt))
+               if val != (row['current_val'] or '')]
+    if updates:
+        stmt = ('update {} set [{}] = %s where [PMI ID] = %s'
+                ''.format(db_table_name, COLUMN_NAME))
+        db_executemany(db_spec, stmt, updates)
+    return len(updates)
@@ -1,6 +1,9 @@
+import re
 import time
-import pytds
-import certifi
+import datetime
+import atexit
+import threading
+import contextlib
 
 '''
 ==============================================================================
@@ -32,6 +35,17 @@ python-tds @ git+https://github.com/denisenkom/pytds/#egg=python-tds
 QUERY = 'query'
 NONQUERY = 'nonquery'
 
+# Load methods for db_insert_many.
+EXECUTEMANY = 'executemany'
+BATCHED = 'batched'
+BULK = 'bulk'
+
+# SQL Server allows at most 2100 parameters per request; sp_executesql's
+# own @stmt and @params take two of those.
+MAX_PARAMS = 2098
+# ... and at most 1000 rows in a VALUES list.
+MAX_VALUES_ROWS = 1000
+
 # Nov 2020 not checking version; moved to latest version from git master branch.
 # Require version 1.9.1 of pytds.
 # Note: version 1.9.1 confusingly returns '1.9.0'.
@@ -57,6 +71,15 @@ qy_check_conn_encrypted = '''
     from sys.dm_exec_connections
     where session_id = @@spid '''
 
+def _spec_key(db_spec):
+    '''Hashable key identifying a db_spec (ignores `cafile`, which we
+    override).'''
+    return tuple(sorted((k, str(v)) for k, v in db_spec.items()
+                        if k != 'cafile'))
+
+# db_specs whose server certificate has already been verified via a test_conn.
+_verified_specs = set()
+
 def db_make_secure_conn_obj(db_spec, as_dict=True, autocommit=True):
     '''
     Returns a secure, encrypted db connection object. Caller is
@@ -67,12 +90,17 @@ def db_make_secure_conn_obj(db_spec, as_dict=True, autocommit=True):
           automatically in this case).
         - pytds.connect can also raise exceptions.
     '''
+    # Imported here so that importing this module stays cheap.
+    import pytds
+    import certifi
     if 'database' not in db_spec:
         raise NoDatabaseSpecifiedException
     # Enforce TLS via `cafile` key-value pair. Note that pytds does not allow self-signed
     # certs so this will enforce cert verification as well.
     # See certifi documentation for more details on what `where()` does.
-    db_spec['cafile'] = certifi.where()
+    # Set on a copy: db_spec may be shared by threads (e.g. concurrent loads)
+    # iterating it in _spec_key.
+    conn_spec = dict(db_spec, cafile=certifi.where())
     # Comment on 'login_timeout' and why we do both `test_conn` and `conn` below:
     # Create test_conn with default of 15 for login_timeout; however this also is
     # the connect_timeout and needs to be much larger in prod scenarios; so,
@@ -81,41 +109,137 @@ def db_make_secure_conn_obj(db_spec, as_dict=True, autocommit=True):
     # that situation is not desirable (library will make retries).
     # Regarding login_timeout, see: https://github.com/denisenkom/pytds/issues/37
     # It prevents random errors, which pytds otherwise seems to have an issue with.
-    test_conn = pytds.connect(**db_spec)
-    # if no exception thrown, so far so good. This means server's certificate is OK.
-    # So, close test_conn and do actual conn with different login_timeout value.
-    test_conn.close()
-    conn = pytds.connect(**db_spec,
+    # The test_conn is only needed once per db_spec per process.
+    key = _spec_key(db_spec)
+    if key not in _verified_specs:
+        test_conn = pytds.connect(**conn_spec)
+        # if no exception thrown, so far so good. This means server's certificate is OK.
+        # So, close test_conn and do actual conn with different login_timeout value.
+        test_conn.close()
+        _verified_specs.add(key)
+    conn = pytds.connect(**conn_spec,
                         as_dict=as_dict,
                         autocommit=autocommit,
                         login_timeout=1200)    
     cur = conn.cursor()
     # Now, ensure encrypted connection.
     cur.execute(qy_check_conn_encrypted)
-    rslt = cur.fetchone()['encrypt_option']
+    rslt = cur.fetchone()
     cur.close()
-    if rslt != 'TRUE':
+    if not as_dict:
+        rslt = {'encrypt_option': rslt[0]}
+    if rslt['encrypt_option'] != 'TRUE':
         # Conn not encrypted, so we bail.
         conn.close()
         raise ConnectionNotSecureException
     else:
         return conn
 
-def _run(db_spec, sql, kind, as_dict=True):
-    '''kind should be `query` or `nonquery` (see vars at top of file)'''
-    conn = db_make_secure_conn_obj(db_spec, as_dict)
-    cur = conn.cursor()
-    cur.execute(sql)
-    rslt = None
-    if kind == QUERY:
-        while cur.description == None:
-            cur.nextset()
-        rslt = cur.fetchall()
-    elif kind == NONQUERY:
+#------------------------------------------------------------------------------
+# Connection pool
+#
+# Opening a secure connection costs a TLS handshake, a login and the
+# encryption check above, so the db_* functions below share connections
+# via this pool instead. Connections are pooled per (db_spec, as_dict,
+# autocommit) and are only handed out once they've passed
+# db_make_secure_conn_obj. Idle connections are closed at process exit.
+
+# Idle connections older than this are closed rather than reused (the
+# server or a firewall may have dropped them in the meantime). Younger ones
+# are still checked with _is_alive before being handed out.
+POOL_MAX_IDLE_SECONDS = 300
+
+_pool_lock = threading.Lock()
+_pool_idle = {} # key -> list of (conn, time returned to pool)
+
+def _is_alive(conn):
+    '''True if conn still answers a trivial query (it may have been
+    dropped by the server, e.g. on a restart or failover).'''
+    try:
+        cur = conn.cursor()
+        try:
+            cur.execute('SELECT 1')
+            cur.fetchall()
+        finally:
+            cur.close()
+        return True
+    except Exception:
+        return False
+
+def _pool_checkout(key, db_spec, as_dict, autocommit):
+    while True:
+        with _pool_lock:
+            idle = _pool_idle.get(key, [])
+            if not idle:
+                break
+            conn, returned_at = idle.pop()
+        # Checked outside the lock; conn is ours alone now.
+        if (time.monotonic() - returned_at <= POOL_MAX_IDLE_SECONDS
+                and _is_alive(conn)):
+            return conn
+        _close_quietly(conn)
+    return db_make_secure_conn_obj(db_spec, as_dict, autocommit)
+
+def _pool_checkin(key, conn):
+    with _pool_lock:
+        _pool_idle.setdefault(key, []).append((conn, time.monotonic()))
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
         pass
+
+@contextlib.contextmanager
+def db_conn(db_spec, as_dict=True, autocommit=True):
+    '''
+    Context manager handing out a pooled secure connection (see
+    db_make_secure_conn_obj), e.g.:
+
+        with db_conn(db_spec) as conn:
+            cur = conn.cursor()
+            ...
+
+    The connection goes back to the pool afterward. If the block raises,
+    the connection is closed instead, since its state is unknown.
+    '''
+    if 'database' not in db_spec:
+        raise NoDatabaseSpecifiedException
+    key = (_spec_key(db_spec), as_dict, autocommit)
+    conn = _pool_checkout(key, db_spec, as_dict, autocommit)
+    try:
+        yield conn
+    except BaseException:
+        _close_quietly(conn)
+        raise
     else:
+        _pool_checkin(key, conn)
+
+def db_close_all():
+    '''Close all idle pooled connections. Runs automatically at exit.'''
+    with _pool_lock:
+        for conns in _pool_idle.values():
+            for conn, _ in conns:
+                _close_quietly(conn)
+        _pool_idle.clear()
+
+atexit.register(db_close_all)
+
+#------------------------------------------------------------------------------
+
+def _run(db_spec, sql, kind, as_dict=True):
+    '''kind should be `query` or `nonquery` (see vars at top of file)'''
+    if kind not in (QUERY, NONQUERY):
         raise Exception('unknown `kind` value of {} passed in'.format(kind))
-    conn.close()
+    rslt = None
+    with db_conn(db_spec, as_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(sql)
+        if kind == QUERY:
+            while cur.description == None:
+                cur.nextset()
+            rslt = cur.fetchall()
+        cur.close()
     return rslt
 
 def db_qy(db_spec, qy, as_dict=True):
@@ -140,10 +264,10 @@ def db_trunc_table(db_spec, table_name):
 def db_executemany(db_spec, stmt, tuples):
     '''Execute a parameterized statement for a collection of rows.
     tuples should be a sequence of tuples (not maps).'''
-    conn = db_make_secure_conn_obj(db_spec)
-    cur = conn.cursor()
-    cur.executemany(stmt, tuples)
-    conn.close()
+    with db_conn(db_spec) as conn:
+        cur = conn.cursor()
+        cur.executemany(stmt, tuples)
+        cur.close()
 
 def db_drop_table(db_spec, schema, table):
     ddl = ddl_drop_table(schema, table)
@@ -153,6 +277,16 @@ def make_fqtn(catalog, schema, table):
     '''Returns fully qualified table name as a string.'''
     return '[' + catalog + '].[' + schema + '].[' + table + ']'
 
+def _split_fqtn(fqtn):
+    return [part.replace('[', '').replace(']', '') for part in fqtn.split('.')]
+
+def fqtn_with_suffix(fqtn, suffix):
+    '''fqtn (bracketed or not) with suffix added to the table name only,
+    e.g. '[db].[dbo].[t]' and '_stage' give '[db].[dbo].[t_stage]'.'''
+    parts = _split_fqtn(fqtn)
+    parts[-1] += suffix
+    return '.'.join('[' + part + ']' for part in parts)
+
 def db_table_from_fqtn(fqtn, brackets=False):
     out = fqtn.split('.')[-1].replace('[','').replace(']','')
     if brackets:
@@ -219,22 +353,258 @@ def db_create_table(db_spec, schema, table, table_info):
     ddl = ddl_create_table(schema, table, table_info)
     return db_stmt(db_spec, ddl)
 
-def _parameterized_insert_stmt(table_name, data):
-    '''data should be a sequence of maps.'''
+def _parameterized_insert_stmt(table_name, data, rows=1):
+    '''data should be a sequence of maps. With rows > 1, returns a multi-row
+    statement: insert ... values (...),(...),... with `rows` rows.'''
+    values = '(' + ','.join(list(map(lambda x: '%s', data[0]))) + ')'
     stmt = ('insert into ' + table_name
              + ' ([' 
              + '],['.join(data[0]) # All rows should have same keys.
-             + ']) values ('
-             + ','.join(list(map(lambda x: '%s', data[0])))
-             + ')')
+             + ']) values '
+             + ','.join([values] * rows))
     return stmt
 
-def db_insert_many(db_spec, table_name, data):
-    '''Takes a seq of maps. Doesn't return anything.'''
+def rows_per_insert(ncols):
+    '''How many rows of ncols columns fit in one parameterized statement.'''
+    return max(1, min(MAX_PARAMS // ncols, MAX_VALUES_ROWS))
+
+def db_insert_many(db_spec, table_name, data, method=EXECUTEMANY,
+                   batch_size=None, table_info=None):
+    '''Takes a seq of maps. Doesn't return anything.
+    method is one of:
+      - EXECUTEMANY (default): one parameterized insert per row.
+      - BATCHED: multi-row inserts (see db_insert_batched); batch_size,
+        if given, caps the rows per statement.
+      - BULK: TDS bulk load (see db_bulk_insert, which needs table_info).'''
+    if method == BULK:
+        db_bulk_insert(db_spec, table_name, data, table_info,
+                       batch_size or BULK_BATCH_SIZE)
+        return
+    if method == BATCHED:
+        db_insert_batched(db_spec, table_name, data, batch_size)
+        return
+    if method != EXECUTEMANY:
+        raise Exception('unknown `method` value of {} passed in'.format(method))
     stmt = _parameterized_insert_stmt(table_name, data) 
     tuples = list(map(lambda mp: tuple([mp[k] for k in mp]), data))
     db_executemany(db_spec, stmt, tuples)
 
+def db_insert_batched(db_spec, table_name, data, rows=None):
+    '''
+    Takes a seq of maps and inserts them with multi-row INSERT ... VALUES
+    statements, as many rows per statement as the 2100-parameter limit
+    allows (about 12 for the HealthPro table) or `rows` if smaller. All
+    statements run in a single transaction, which is rolled back if any
+    of them fails. For servers where bulk loads aren't permitted.
+    '''
+    if not data:
+        return
+    keys = list(data[0]) # All rows should have same keys.
+    per_stmt = rows_per_insert(len(keys))
+    if rows:
+        per_stmt = min(per_stmt, rows)
+    full_stmt = _parameterized_insert_stmt(table_name, data, per_stmt)
+    with db_conn(db_spec, autocommit=False) as conn:
+        cur = conn.cursor()
+        try:
+            for i in range(0, len(data), per_stmt):
+                chunk = data[i:i + per_stmt]
+                stmt = (full_stmt if len(chunk) == per_stmt else
+                        _parameterized_insert_stmt(table_name, data, len(chunk)))
+                cur.execute(stmt, tuple(mp[k] for mp in chunk for k in keys))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+#------------------------------------------------------------------------------
+# Bulk load (TDS bulk-load protocol via pytds' copy_to)
+
+BULK_BATCH_SIZE = 10000
+
+# One column definition per line, as in sql/create-table.sql, e.g.:
+#   ,[General Consent Date] DATE NULL
+#   ,[Biospecimen Status] [NVARCHAR](1000) NULL
+_column_def_re = re.compile(r'^\s*,?\s*\[(?P<name>[^\]]+)\]\s+'
+                            r'\[?(?P<type>\w+)\]?\s*'
+                            r'(\((?P<len>\w+)\))?'
+                            r'(?P<rest>.*)$')
+
+def parse_ddl_columns(ddl):
+    '''Returns column info, shaped like db_get_table_info's results, for
+    the column definitions in a CREATE TABLE statement.'''
+    out = []
+    for line in ddl.splitlines():
+        m = _column_def_re.match(line)
+        if not m:
+            continue
+        size = m.group('len')
+        if size is not None:
+            size = -1 if size.lower() == 'max' else int(size)
+        out.append({'ordinal_position': len(out) + 1,
+                    'column_name': m.group('name'),
+                    'data_type': m.group('type').lower(),
+                    'character_maximum_length': size,
+                    'is_nullable': ('NO' if 'not null' in m.group('rest').lower()
+                                    else 'YES')})
+    return out
+
+def _parse_hp_datetime(val):
+    '''Values arrive as strings in the HealthPro formats produced by
+    transform (e.g. '03/01/2021' or '03/01/2021 07:00 AM').'''
+    if val is None:
+        return None
+    if val == '':
+        # Match what SQL Server does when executemany sends '' for a
+        # date/datetime2 column.
+        return datetime.datetime(1900, 1, 1)
+    if isinstance(val, datetime.date):
+        return val
+    for fmt in ('%m/%d/%Y %I:%M %p', '%m/%d/%Y', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(val, fmt)
+        except ValueError:
+            pass
+    raise ValueError('unrecognized date value: {!r}'.format(val))
+
+def _to_date(val):
+    val = _parse_hp_datetime(val)
+    return val.date() if isinstance(val, datetime.datetime) else val
+
+def _to_str(val):
+    return val if val is None or isinstance(val, str) else str(val)
+
+def _bulk_column(info):
+    '''Returns (pytds Column, value converter) for a column info map.'''
+    from pytds.tds_base import Column
+    from pytds.tds_types import (NVarCharType, NVarCharMaxType, DateType,
+                                 DateTime2Type)
+    data_type = info['data_type']
+    size = info['character_maximum_length']
+    if data_type == 'date':
+        typ, conv = DateType(), _to_date
+    elif data_type == 'datetime2':
+        typ, conv = DateTime2Type(precision=7), _parse_hp_datetime
+    elif size is None or size == -1 or size > 4000:
+        # varchar too; the server converts on the way in.
+        typ, conv = NVarCharMaxType(), _to_str
+    else:
+        typ, conv = NVarCharType(size=size), _to_str
+    flags = Column.fNullable if info['is_nullable'] == 'YES' else 0
+    return Column(name=info['column_name'], type=typ, flags=flags), conv
+
+def db_bulk_insert(db_spec, table_name, data, table_info,
+                   batch_size=BULK_BATCH_SIZE, tablock=True):
+    '''
+    Takes a seq of maps and loads them into table_name (a fully qualified
+    'catalog.schema.table' name) with the TDS bulk-load protocol, which
+    is far faster than row-by-row inserts. table_info describes the
+    columns (see parse_ddl_columns and db_get_table_info) and must cover
+    every key in the rows; values are converted to the column types
+    before sending. Rows are sent batch_size at a time, with TABLOCK by
+    default. Doesn't return anything.
+    '''
+    if not data:
+        return
+    catalog = table_name.split('.')[0].replace('[','').replace(']','')
+    schema = db_schema_name_from_fqtn(table_name)
+    table = db_table_from_fqtn(table_name)
+    db_spec = db_spec.copy()
+    db_spec['database'] = catalog
+    info_by_name = {r['column_name']: r for r in table_info}
+    keys = list(data[0]) # All rows should have same keys.
+    columns, convs = zip(*[_bulk_column(info_by_name[k]) for k in keys])
+    with db_conn(db_spec) as conn:
+        cur = conn.cursor()
+        for i in range(0, len(data), batch_size):
+            rows = [tuple(conv(mp[k]) for k, conv in zip(keys, convs))
+                    for mp in data[i:i + batch_size]]
+            cur.copy_to(None, table, columns=list(columns), data=rows,
+                        schema=schema, rows_per_batch=len(rows),
+                        tablock=tablock)
+        cur.close()
+
+def ddl_merge(target, source, key_col, cols):
+    '''Returns a MERGE statement that upserts every row of table `source`
+    into table `target`, matching rows on key_col. cols is the list of
+    column names to copy (should include key_col).'''
+    qcols = ['[' + col + ']' for col in cols]
+    upd = ', '.join('t.' + q + ' = s.' + q
+                    for col, q in zip(cols, qcols) if col != key_col)
+    stmt = ('merge ' + target + ' as t using ' + source + ' as s'
+            ' on t.[' + key_col + '] = s.[' + key_col + ']'
+            ' when matched then update set ' + upd
+            + ' when not matched by target then insert ('
+            + ','.join(qcols) + ') values ('
+            + ','.join('s.' + q for q in qcols) + ');')
+    return stmt
+
+def ddl_create_index_if_missing(table_name, index_name, cols):
+    '''Returns a statement creating nonclustered index index_name on cols
+    of table_name (fully qualified), unless the table already has it.'''
+    catalog = _split_fqtn(table_name)[0]
+    return ("if not exists (select 1 from [{0}].sys.indexes"
+            " where object_id = object_id(N'{1}') and name = N'{2}')"
+            " create index [{2}] on {1} ({3})"
+            "".format(catalog, table_name, index_name,
+                      ', '.join('[' + col + ']' for col in cols)))
+
+def db_delete_keys(db_spec, table_name, key_col, keys, chunk_size=1000):
+    '''Deletes the rows of table_name whose key_col is one of keys.'''
+    keys = list(keys)
+    with db_conn(db_spec) as conn:
+        cur = conn.cursor()
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            stmt = ('delete from ' + table_name + ' where [' + key_col
+                    + '] in (' + ','.join(['%s'] * len(chunk)) + ')')
+            cur.execute(stmt, tuple(chunk))
+        cur.close()
+
+#------------------------------------------------------------------------------
+# Table swap (zero-downtime loads)
+
+def db_swap_tables(db_spec, table_name, new_name, old_name):
+    '''
+    Puts table new_name in place of table_name in one short transaction:
+    drops old_name if it exists, renames table_name (if it exists) to
+    old_name and new_name to table_name. All three are fully qualified
+    names ('catalog.schema.table') in the same catalog and schema. Readers
+    of table_name see either the old or the new table, never neither.
+    '''
+    catalog, schema, table = _split_fqtn(table_name)
+    new_table = _split_fqtn(new_name)[-1]
+    old_table = _split_fqtn(old_name)[-1]
+    live = make_fqtn(catalog, schema, table)
+    old = make_fqtn(catalog, schema, old_table)
+    rename = ("exec [{}].sys.sp_rename N'[{}].[{{}}]', N'{{}}'"
+              "".format(catalog, schema))
+    stmts = [
+        "set xact_abort on",
+        ("if object_id(N'{}', 'U') is not null drop table {}"
+         "".format(old, old)),
+        ("if object_id(N'{}', 'U') is not null {}"
+         "".format(live, rename.format(table, old_table))),
+        rename.format(new_table, table),
+    ]
+    with db_conn(db_spec, autocommit=False) as conn:
+        cur = conn.cursor()
+        try:
+            for stmt in stmts:
+                cur.execute(stmt)
+            conn.commit()
+            # xact_abort is session-wide; don't hand it on to the next user
+            # of this pooled connection. (If anything above raised, db_conn
+            # closes the connection instead of pooling it.)
+            cur.execute("set xact_abort off")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
 def db_table_does_exist(db_spec, qtn):
     '''Returns boolen.
     Argument `qtn` (qualified table name) should be 
@@ -246,68 +616,204 @@ def db_table_does_exist(db_spec, qtn):
 
 def db_start_job(db_spec, job_name):
     '''Start a SQL Server Agent job. Returns immediately.'''
-    conn = db_make_secure_conn_obj(db_spec)
-    cur = conn.cursor()
-    cur.callproc('msdb.dbo.sp_start_job', (job_name,))
-    conn.close()
+    with db_conn(db_spec) as conn:
+        cur = conn.cursor()
+        cur.callproc('msdb.dbo.sp_start_job', (job_name,))
+        cur.close()
 
 def db_is_job_idle(db_spec, job_name):
     '''job_name should be a SQL Server Agent job name. Returns boolean.'''
     result = []
-    conn = db_make_secure_conn_obj(db_spec)
-    cur = conn.cursor()
-    stmt = "exec msdb.dbo.sp_help_job @job_name=N'" + job_name + "'"
-    cur.execute(stmt) 
-    result = cur.fetchall()
-    conn.close()
+    stmt = "exec msdb.dbo.sp_help_job @job_name=%s"
+    with db_conn(db_spec) as conn:
+        cur = conn.cursor()
+        cur.execute(stmt, (job_name,))
+        result = cur.fetchall()
+        cur.close()
     return result[0]['current_execution_status'] == 4 # 4 means idle.
 
 def db_last_run_succeeded(db_spec, job_name):
     '''job_name should be a SQL Server Agent job name. Returns boolean.'''
     result = []
-    conn = db_make_secure_conn_obj(db_spec)
-    cursor = conn.cursor()
-    stmt = "exec msdb.dbo.sp_help_job @job_name=N'" + job_name + "'"
-    cursor.execute(stmt) 
-    result = cursor.fetchall()
-    conn.close()
+    stmt = "exec msdb.dbo.sp_help_job @job_name=%s"
+    with db_conn(db_spec) as conn:
+        cursor = conn.cursor()
+        cursor.execute(stmt, (job_name,))
+        result = cursor.fetchall()
+        cursor.close()
     return result[0]['last_run_outcome'] == 1 # 1 means succeeded.
 
+# Polling for a started agent job: the first check comes after
+# JOB_POLL_FIRST seconds, then the interval grows by JOB_POLL_GROWTH up to
+# JOB_POLL_MAX, so short jobs are noticed quickly and long ones cost little.
+JOB_POLL_FIRST = 0.25
+JOB_POLL_GROWTH = 1.5
+JOB_POLL_MAX = 15.0
+
+# sysjobhistory.run_status values.
+JOB_FAILED = 0
+JOB_SUCCEEDED = 1
+JOB_RETRY = 2
+JOB_CANCELED = 3
+
+# Seconds to wait, once a run has stopped, for its sysjobhistory row
+# before giving up on learning its outcome (the row may have been purged,
+# e.g. by msdb's job history size limits).
+JOB_HISTORY_GRACE = 30.0
+
+def _job_id(cur, job_name):
+    cur.execute('select job_id from msdb.dbo.sysjobs where name = %s',
+                (job_name,))
+    rows = cur.fetchall()
+    if not rows:
+        raise AgentJobException('No agent job named [{}]'.format(job_name))
+    return rows[0]['job_id']
+
+def _start_job(cur, job_name):
+    '''Starts the job; returns (job_id, server time just before the start
+    request), which identify this run in sysjobactivity.'''
+    job_id = _job_id(cur, job_name)
+    cur.execute('select getdate() as now')
+    requested_after = cur.fetchall()[0]['now']
+    cur.callproc('msdb.dbo.sp_start_job', (job_name,))
+    return job_id, requested_after
+
+def _job_run_status(cur, job_id, requested_after):
+    '''None while the run started at requested_after (see _start_job) is
+    still going; afterward, its (run_status, message) from sysjobhistory,
+    both None if the run has stopped but has no history row (not written
+    yet, or purged).'''
+    cur.execute(
+        'select top 1 a.stop_execution_date, h.run_status, h.message'
+        ' from msdb.dbo.sysjobactivity a'
+        ' left join msdb.dbo.sysjobhistory h'
+        '   on h.instance_id = a.job_history_id'
+        ' where a.job_id = %s and a.run_requested_date >= %s'
+        '   and a.session_id = (select max(session_id)'
+        '                       from msdb.dbo.syssessions)'
+        ' order by a.run_requested_date desc',
+        (job_id, requested_after))
+    rows = cur.fetchall()
+    if not rows or rows[0]['stop_execution_date'] is None:
+        return None
+    return rows[0]['run_status'], rows[0]['message']
+
+def _check_job_outcome(job_name, status):
+    run_status, message = status
+    if run_status != JOB_SUCCEEDED:
+        raise AgentJobException('The Agent job [{}] did not run successfully '
+                                '(run_status {}): {}'.format(
+                                    job_name, run_status, message))
+    return True
+
+class AgentJobRun:
+    '''
+    Handle on an agent job run started by start_agent_job. Either:
+
+        run.poll()     # None while running, True once it succeeded
+        run.wait()     # blocks until done; returns True
+        await run      # same as wait() but without blocking an event loop
+
+    All of them raise AgentJobException if the run failed or is still
+    going timeout seconds after it was started. (The job itself keeps
+    running in that case.) They also raise if the run has stopped but its
+    outcome still isn't in sysjobhistory JOB_HISTORY_GRACE seconds later.
+    '''
+    def __init__(self, db_spec, job_name, timeout):
+        self.db_spec = db_spec
+        self.job_name = job_name
+        self.timeout = timeout
+        with db_conn(db_spec) as conn:
+            cur = conn.cursor()
+            self.job_id, self.requested_after = _start_job(cur, job_name)
+            cur.close()
+        self.deadline = time.monotonic() + timeout
+        self.interval = JOB_POLL_FIRST
+        self.status = None
+        self.stopped_at = None
+
+    def _check(self, cur):
+        if self.status is None:
+            status = _job_run_status(cur, self.job_id, self.requested_after)
+            if status is not None and status[0] is None:
+                if self.stopped_at is None:
+                    self.stopped_at = time.monotonic()
+                if time.monotonic() - self.stopped_at >= JOB_HISTORY_GRACE:
+                    raise AgentJobException(
+                        'The Agent job [{}] has finished, but its outcome '
+                        'is not in msdb.dbo.sysjobhistory (it may have been '
+                        'purged); check the job\'s history.'
+                        ''.format(self.job_name))
+                status = None
+            self.status = status
+        if self.status is not None:
+            return _check_job_outcome(self.job_name, self.status)
+        if time.monotonic() >= self.deadline:
+            raise AgentJobException('Runtime for job [{}] has exceeded '
+                                    'specified threshold of {} seconds.'
+                                    ''.format(self.job_name, self.timeout))
+        return None
+
+    def _next_sleep(self):
+        sleep = min(self.interval, max(0, self.deadline - time.monotonic()))
+        self.interval = min(self.interval * JOB_POLL_GROWTH, JOB_POLL_MAX)
+        return sleep
+
+    def poll(self):
+        '''One check (a short query on a pooled connection).'''
+        with db_conn(self.db_spec) as conn:
+            cur = conn.cursor()
+            result = self._check(cur)
+            cur.close()
+        return result
+
+    def wait(self):
+        '''Polls, less and less often, on a single connection until done.'''
+        with db_conn(self.db_spec) as conn:
+            cur = conn.cursor()
+            while True:
+                time.sleep(self._next_sleep())
+                result = self._check(cur)
+                if result is not None:
+                    break
+            cur.close()
+        return result
+
+    async def _wait_async(self):
+        # Imported here so that sync callers don't load asyncio.
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self._next_sleep())
+            result = await loop.run_in_executor(None, self.poll)
+            if result is not None:
+                return result
+
+    def __await__(self):
+        return self._wait_async().__await__()
+
+def start_agent_job(db_spec, job_name, timeout_threshold=60):
+    '''Starts an agent job and returns an AgentJobRun for it right away.'''
+    return AgentJobRun(db_spec, job_name, timeout_threshold)
+
 def db_run_agent_job(db_spec, job_name, timeout_threshold=60):
   '''Run an agent job in a synchronous fashion -- that is, this
   function will not return until the job has completed/failed OR the
   timeout_threshold amount of seconds has passed (will raise Exception
-  in the latter case). Timeout default is 2 minutes. Note: the agent
-  job might/will continue running even if timeout_threshold is passed.'''
+  in the latter case). Timeout default is 1 minute. Note: the agent
+  job might/will continue running even if timeout_threshold is passed.
+
+  Checks on this particular run in msdb's sysjobactivity/sysjobhistory,
+  polling JOB_POLL_FIRST seconds after the start and then less and less
+  often (up to every JOB_POLL_MAX seconds). See start_agent_job to start
+  a job without waiting for it.'''
   try:
-    db_start_job(db_spec, job_name)
-    # Below we poll to see if the job has finished; when finished we check if
-    # it was successful. If the job is still running past the designated
-    # threshold, then we raise an exception, with the assumption that something
-    # is wrong.
-    interval = 10 # Check every 10 seconds.
-    havewaited = 0 # How long have we been waiting so far?
-    while True:
-      time.sleep(interval)
-      if not db_is_job_idle(db_spec, job_name):
-        havewaited += interval
-        if havewaited > timeout_threshold:
-          raise AgentJobException('Runtime for job [{}] has exceeded '\
-                          'specified threshold of {} seconds.'\
-                          ''.format(job_name, timeout_threshold))
-        else:
-          print('Waiting for job to finish ...')
-          continue
-      else:
-        break
+    return start_agent_job(db_spec, job_name, timeout_threshold).wait()
+  except AgentJobException:
+    raise
   except Exception as ex:
     raise AgentJobException('Exception occurred when attempting to run the Agent Job '
             '[{}]; details: {}'.format(job_name, str(ex)))
-  if not db_last_run_succeeded(db_spec, job_name):
-    raise AgentJobException('The Agent job [{}] did not run successfully. Check job history in SSMS.'\
-                    ''.format(job_name))
-  else:
-    return True 
 
 def db_get_table_info(db_spec, schema, table):
     '''Returns data about a table's columns and data types.'''
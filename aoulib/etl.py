@@ -1,31 +1,621 @@
+import os
+import json
+import time
+import itertools
+import threading
+import multiprocessing
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from . import core as c
+from . import fetch
+from . import pagecache
 from . import transform as t
 from . import db
+from . import metrics
 from . import active_retention_date
+from .utils import slurpj, spit
 
-def api2db(api_spec, db_spec, db_table_name, custom_params, maxrows=None):
-  sess = c.make_authed_session_obj(api_spec)
-  api_dataset = c.get_records(api_spec, sess, custom_params, maxrows)
-  hp_rows = list(map(t.into_hp_row, api_dataset))
+# Column identifying a participant's row in the HealthPro table.
+KEY_COLUMN = 'PMI ID'
 
-  # drop/recreate table
-  db.db_drop_table(
-    db_spec,
-    db.db_schema_name_from_fqtn(db_table_name),
-    db.db_table_from_fqtn(db_table_name))
+# Index on KEY_COLUMN that api2db_incremental adds to its table, for its
+# MERGE and deletes.
+KEY_INDEX = 'ix_pmi_id'
+
+def _create_table_ddl():
   with open('sql/create-table.sql') as f:
-    ddl = f.read()
+    return f.read()
+
+def _table_info():
+  '''Column info for the HealthPro table (see db.db_bulk_insert).'''
+  return (db.parse_ddl_columns(_create_table_ddl())
+          + [active_retention_date.COLUMN_INFO])
+
+def _recreate_table(db_spec, db_table_name):
+  '''Drops and recreates the HealthPro table, including calculated column(s).'''
+  with metrics.stage(metrics.DDL):
+    db.db_drop_table(
+      db_spec,
+      db.db_schema_name_from_fqtn(db_table_name),
+      db.db_table_from_fqtn(db_table_name))
+    ddl = _create_table_ddl()
     db.db_stmt(db_spec, ddl.replace('$TABLE_NAME$', db_table_name))
 
-  # We just recreated table, reintroduce calculated column(s).
-  active_retention_date.add_column_if_needed(db_spec, db_table_name)
+    # We just recreated table, reintroduce calculated column(s).
+    active_retention_date.add_column_if_needed(db_spec, db_table_name)
 
-  # Active Retention Date calculated field.
-  for row in hp_rows:
-    art = active_retention_date.calc_val(row)
+def _add_retention_dates(hp_rows, begin_dt=None):
+  '''Active Retention Date calculated field.'''
+  vals = active_retention_date.calc_vals(hp_rows, begin_dt)
+  for row, art in zip(hp_rows, vals):
     row[active_retention_date.COLUMN_NAME] = art
+  return hp_rows
+
+def _insert(db_spec, db_table_name, hp_rows, load_method, load_batch_size):
+  table_info = _table_info() if load_method == db.BULK else None
+  with metrics.stage(metrics.LOAD, len(hp_rows)):
+    db.db_insert_many(db_spec, db_table_name, hp_rows,
+                      load_method, load_batch_size, table_info)
+
+def _batches(pages, batch_size):
+  '''Generator; regroups pages of rows into lists of batch_size rows
+  (the last one may be shorter).'''
+  batch = []
+  for rows in pages:
+    batch.extend(rows)
+    if len(batch) >= batch_size:
+      full = len(batch) - len(batch) % batch_size
+      for i in range(0, full, batch_size):
+        yield batch[i:i + batch_size]
+      batch = batch[full:]
+  if batch:
+    yield batch
+
+# Transform engines: ROW_ENGINE converts one record at a time
+# (transform.into_hp_row), COLUMNAR_ENGINE a whole page or chunk column
+# by column (transform.into_hp_columns). The output is the same.
+ROW_ENGINE = 'row'
+COLUMNAR_ENGINE = 'columnar'
+
+def _transform_chunk(rcds, begin_dt=None, engine=ROW_ENGINE):
+  '''API records into finished HealthPro rows. Runs in pool workers too,
+  so begin_dt (see active_retention_date.window_start) is passed in.'''
+  with metrics.stage(metrics.TRANSFORM, len(rcds)):
+    if engine == COLUMNAR_ENGINE:
+      hp_rows = t.columns_to_dicts(t.into_hp_columns(rcds))
+    else:
+      hp_rows = list(map(t.into_hp_row, rcds))
+  with metrics.stage(metrics.RETENTION, len(hp_rows)):
+    return _add_retention_dates(hp_rows, begin_dt)
+
+def _chunk_result(future):
+  '''A pool worker's _transform_chunk result. Workers don't record
+  metrics, so the wait is counted as metrics.TRANSFORM here (Active
+  Retention Date included).'''
+  with metrics.stage(metrics.TRANSFORM) as st:
+    rows = future.result()
+    st.rows = len(rows)
+  return rows
+
+# How _hp_pages starts its pool's workers. Not 'fork': the fetch threads
+# (prefetch, partitions, the asyncio loop) are running by then, and a child
+# forked while one of them holds a lock can deadlock.
+TRANSFORM_START_METHOD = 'forkserver'
+
+def _hp_pages(pages, workers=0, chunk_size=500, begin_dt=None,
+              engine=ROW_ENGINE):
+  '''
+  Generator; turns pages of API records into lists of finished HealthPro
+  rows, in order. With workers > 1 the records are regrouped into chunks
+  of chunk_size and transformed on a process pool, keeping at most
+  2 * workers chunks in flight; otherwise each page is transformed
+  serially in this process (deterministic, easiest to debug). Every chunk
+  uses the same Active Retention window, begin_dt, defaulting to today's,
+  and the same transform engine.
+  '''
+  if begin_dt is None:
+    begin_dt = active_retention_date.window_start()
+  if not workers or workers <= 1:
+    for page in pages:
+      yield _transform_chunk(page, begin_dt, engine)
+    return
+  ctx = multiprocessing.get_context(TRANSFORM_START_METHOD)
+  with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+    pending = collections.deque()
+    for chunk in _batches(pages, chunk_size):
+      pending.append(pool.submit(_transform_chunk, chunk, begin_dt,
+                                 engine))
+      if len(pending) >= workers * 2:
+        yield _chunk_result(pending.popleft())
+    while pending:
+      yield _chunk_result(pending.popleft())
+
+# Load modes for api2db. DIRECT_LOAD drops and reloads the table in place;
+# SWAP_LOAD loads a staging table and swaps it in (see db.db_swap_tables),
+# keeping the previous generation for rollback_swap.
+DIRECT_LOAD = 'direct'
+SWAP_LOAD = 'swap'
+STAGE_SUFFIX = '_stage'
+PREV_SUFFIX = '_prev'
+
+# Optional; run against the staging table after a SWAP_LOAD, like
+# sql/create-table.sql ($TABLE_NAME$ is replaced).
+INDEXES_SQL = 'sql/create-indexes.sql'
+
+def _finish_stage(db_spec, stage_name):
+  '''Indexes (if INDEXES_SQL exists) and fresh statistics for a loaded
+  staging table, built before it is swapped in.'''
+  if os.path.exists(INDEXES_SQL):
+    with open(INDEXES_SQL) as f:
+      db.db_stmt(db_spec, f.read().replace('$TABLE_NAME$', stage_name))
+  db.db_stmt(db_spec, 'update statistics ' + stage_name)
+
+def _load_target(db_table_name, load_mode):
+  '''Table to (re)create and load for db_table_name under load_mode.'''
+  if load_mode == SWAP_LOAD:
+    return db.fqtn_with_suffix(db_table_name, STAGE_SUFFIX)
+  return db_table_name
+
+def _swap_in(db_spec, db_table_name, stage_name):
+  with metrics.stage(metrics.DDL):
+    _finish_stage(db_spec, stage_name)
+    db.db_swap_tables(db_spec, db_table_name, stage_name,
+                      db.fqtn_with_suffix(db_table_name, PREV_SUFFIX))
+
+def _load_table(db_spec, db_table_name, hp_rows, load_method,
+                load_batch_size, load_mode):
+  '''Replaces the contents of db_table_name with hp_rows.'''
+  target = _load_target(db_table_name, load_mode)
+  _recreate_table(db_spec, target)
+  result = _insert(db_spec, target, hp_rows, load_method, load_batch_size)
+  if load_mode == SWAP_LOAD:
+    _swap_in(db_spec, db_table_name, target)
+  return result
+
+def rollback_swap(db_spec, db_table_name):
+  '''
+  Puts back the generation of db_table_name replaced by the last SWAP_LOAD.
+  The current table becomes the staging table (and is dropped by the next
+  swap load). Raises if there is no previous generation.
+  '''
+  prev_name = db.fqtn_with_suffix(db_table_name, PREV_SUFFIX)
+  if not db.db_table_does_exist(db_spec, prev_name):
+    raise Exception('No previous generation to roll back to: ' + prev_name)
+  db.db_swap_tables(db_spec, db_table_name, prev_name,
+                    db.fqtn_with_suffix(db_table_name, STAGE_SUFFIX))
+
+# Times a failed page request is retried (with backoff; see
+# utils.with_retries) before the fetch gives up.
+FETCH_RETRIES = 5
+
+# Fetch engines. THREAD_FETCH pages on threads with requests sessions
+# (fetch.iter_pages_partitioned, fetch.prefetch); ASYNC_FETCH on one
+# asyncio event loop with aiohttp (fetch.iter_pages_async).
+THREAD_FETCH = 'threads'
+ASYNC_FETCH = 'asyncio'
+
+def _iter_api_pages(api_spec, custom_params, maxrows, partitions, max_workers,
+                    cache_dir=None, replay=None, retries=FETCH_RETRIES,
+                    engine=THREAD_FETCH, page_size=None, on_bundle=None):
+  '''
+  Iterator over pages of API records; see api2db. With cache_dir, an
+  interrupted fetch of the same pages (see pagecache.find_resumable) is
+  resumed: its cached pages come first, then each stream continues from
+  its checkpoint. on_bundle, if given, is called with every raw bundle
+  and its stream key (see fetch.stream_key), cached ones included,
+  before any of its records are yielded.
+  '''
+  if page_size:
+    api_spec = dict(api_spec, **{'page-size': page_size})
+  if replay:
+    return _counted(pagecache.iter_cached_pages(cache_dir, replay, maxrows,
+                                                on_bundle=on_bundle))
+  for partition in partitions or []:
+    # Raises now, before the cache or the fetch starts, on a clash.
+    fetch._merge_params(custom_params, partition)
+  cache = None
+  resume = None
+  if cache_dir:
+    source = {'base-url': api_spec.get('base-url'),
+              'awardee': api_spec.get('awardee'),
+              'params': custom_params,
+              'partitions': partitions}
+    run = pagecache.find_resumable(cache_dir, source)
+    if run:
+      cached = pagecache.iter_cached_pages(cache_dir, run,
+                                           allow_incomplete=True,
+                                           on_bundle=on_bundle)
+      cache = pagecache.PageCacheWriter(cache_dir, source, run, resume=True,
+                                        maxrows=maxrows)
+      resume = cache.streams()
+    else:
+      cache = pagecache.PageCacheWriter(cache_dir, source, maxrows=maxrows)
+    on_bundle = _both(cache.append, on_bundle)
+  if engine == ASYNC_FETCH:
+    pages = fetch.iter_pages_async(api_spec, partitions, custom_params,
+                                   max_workers, maxrows, on_bundle=on_bundle,
+                                   resume=resume, retries=retries)
+  elif partitions:
+    pages = fetch.iter_pages_partitioned(api_spec, partitions, custom_params,
+                                         max_workers, maxrows,
+                                         on_bundle=on_bundle, resume=resume,
+                                         retries=retries)
+  else:
+    key = fetch.stream_key(custom_params)
+    resume_url = (resume or {}).get(key)
+    cb = (lambda bundle: on_bundle(bundle, key)) if on_bundle else None
+    if resume and key in resume and resume_url is None:
+      pages = iter([])
+    else:
+      sess = fetch.authed_session(api_spec, 1)
+      pages = fetch.prefetch(c.iter_pages(api_spec, sess, custom_params,
+                                          maxrows, cb, resume_url, retries))
+  if resume is not None:
+    pages = pagecache.dedup_pages(itertools.chain(cached, pages), maxrows)
+  return _counted(cache.wrap(pages) if cache else pages)
+
+def _both(f, g):
+  '''on_bundle callback calling f, then g if given.'''
+  if not g:
+    return f
+  def both(bundle, key):
+    f(bundle, key)
+    g(bundle, key)
+  return both
+
+def _counted(pages):
+  '''Generator; pages, with their rows counted toward metrics.FETCH.'''
+  for page in pages:
+    metrics.add(metrics.FETCH, rows=len(page), calls=0)
+    yield page
+
+def api2db(api_spec, db_spec, db_table_name, custom_params, maxrows=None,
+           batch_size=None, partitions=None, max_workers=4,
+           load_method=db.EXECUTEMANY, load_batch_size=None,
+           transform_workers=0, transform_chunk_size=500,
+           transform_engine=ROW_ENGINE, load_mode=DIRECT_LOAD,
+           cache_dir=None, replay=None, fetch_retries=FETCH_RETRIES,
+           fetch_engine=THREAD_FETCH, page_size=None):
+  '''
+  Pulls participant data from the API into db_table_name (dropped and
+  recreated each run).
+
+  By default the whole dataset is fetched and transformed before anything
+  is written. If batch_size is given, each API page is transformed as soon
+  as it arrives and rows are inserted batch_size at a time, so memory use
+  depends on batch_size rather than on the number of participants. Note
+  that in that mode (with DIRECT_LOAD) the table is dropped once the first
+  page has arrived, so a later API failure leaves a partially loaded table.
+
+  Pages are fetched on a background thread, one page ahead. If partitions
+  is given (a list of query param maps, see the fetch module), each
+  partition is paged as a separate stream, max_workers at a time, and the
+  results are merged and de-duplicated by participantId.
+
+  load_method is passed to db.db_insert_many: db.EXECUTEMANY (default),
+  db.BATCHED for multi-row INSERTs in one transaction, or db.BULK for the
+  TDS bulk-load path; load_batch_size is passed along as its batch_size.
+
+  transform_workers > 1 runs the transform (into_hp_row and Active
+  Retention Date) on that many processes, transform_chunk_size records
+  per task; rows still come out in API order. The default of 0 transforms
+  serially. transform_engine COLUMNAR_ENGINE transforms each page (or
+  chunk) column by column instead of row by row; see _transform_chunk.
 
-  # Insert finished dataset.
-  result = db.db_insert_many(db_spec, db_table_name, hp_rows)
+  load_mode SWAP_LOAD loads into a staging table instead (db_table_name
+  with STAGE_SUFFIX added to the table name; see db.fqtn_with_suffix),
+  adds indexes (INDEXES_SQL) and statistics, and then swaps it in for
+  db_table_name, which is kept with PREV_SUFFIX added (see
+  rollback_swap). Readers never see a missing or half-loaded table, and a
+  failed load leaves the live table untouched.
+
+  With cache_dir, every raw bundle fetched is also saved as a new run in
+  that page cache (see the pagecache module). With replay (a run name
+  in cache_dir, or pagecache.LATEST) the pages come from that run
+  instead of the API; custom_params and partitions are then not applied.
+  With cache_dir a fetch also checkpoints its progress, and the next call
+  for the same pages resumes an interrupted fetch (see _iter_api_pages).
+  Failed page requests are retried fetch_retries times with backoff.
+  fetch_engine ASYNC_FETCH fetches on asyncio instead of threads (see
+  fetch.AsyncRDRClient), max_workers requests at a time. page_size is the
+  number of records per API page (default utils.PAGE_SIZE), or
+  utils.ADAPTIVE to let each stream grow it while the API stays quick
+  (see utils.PageSizer).
+  '''
+  if batch_size:
+    target = _load_target(db_table_name, load_mode)
+    pages = _iter_api_pages(api_spec, custom_params, maxrows,
+                            partitions, max_workers, cache_dir, replay,
+                            fetch_retries, fetch_engine, page_size)
+    # Don't touch the table until the API has answered at least once.
+    first_page = next(pages, [])
+    _recreate_table(db_spec, target)
+    hp_pages = _hp_pages(itertools.chain([first_page], pages),
+                         transform_workers, transform_chunk_size,
+                         engine=transform_engine)
+    for batch in _batches(hp_pages, batch_size):
+      _insert(db_spec, target, batch, load_method, load_batch_size)
+    if load_mode == SWAP_LOAD:
+      _swap_in(db_spec, db_table_name, target)
+    metrics.mark(metrics.LOADED)
+    return None
+
+  api_dataset = []
+  for page in _iter_api_pages(api_spec, custom_params, maxrows,
+                              partitions, max_workers, cache_dir, replay,
+                              fetch_retries, fetch_engine, page_size):
+    api_dataset.extend(page)
+  metrics.mark(metrics.FETCHED)
+  hp_rows = []
+  for rows in _hp_pages([api_dataset], transform_workers,
+                        transform_chunk_size, engine=transform_engine):
+    hp_rows.extend(rows)
+  metrics.mark(metrics.TRANSFORMED)
+
+  # drop/recreate table and insert finished dataset.
+  result = _load_table(db_spec, db_table_name, hp_rows,
+                       load_method, load_batch_size, load_mode)
+  metrics.mark(metrics.LOADED)
   return result
 
+#------------------------------------------------------------------------------
+# several target tables from one fetch
+
+# Query params api2db_multi can check against a record itself: who the
+# participant is paired with, which the API matches by plain equality.
+LOCAL_FILTER_FIELDS = frozenset(['awardee', 'organization', 'site'])
+
+def _local_filter(params, api_spec):
+  '''params, if they only narrow api_spec's awardee to the records whose
+  LOCAL_FILTER_FIELDS have the given (single) values, so that they can be
+  applied to the awardee's records here; otherwise None.'''
+  for k, v in (params or {}).items():
+    if k not in LOCAL_FILTER_FIELDS or not isinstance(v, str) or ',' in v:
+      return None
+    if k == 'awardee' and v != api_spec.get('awardee'):
+      return None
+  return dict(params or {})
+
+def _target_streams(api_spec, targets, partitions):
+  '''
+  The paging streams (query param maps) for api2db_multi. Targets whose
+  custom_params pass _local_filter share one unfiltered stream of the
+  awardee (one per partition, if partitions is given), and are filtered
+  here; the others each page their own custom_params combined with each
+  partition (see fetch._merge_params). Streams are not repeated.
+
+  Also returns a map of each stream's key (see fetch.stream_key) to the
+  names of the tables it feeds, and a map of the names of the targets
+  filtered here to their filters.
+  '''
+  streams = []
+  tables = {}
+  filters = {}
+
+  def add(params, name):
+    key = fetch.stream_key(params)
+    if key not in tables:
+      streams.append(params)
+      tables[key] = set()
+    tables[key].add(name)
+
+  for target in targets:
+    name = target['db_table_name']
+    local = _local_filter(target.get('custom_params'), api_spec)
+    if local is not None:
+      filters[name] = local
+    for partition in partitions or [{}]:
+      if local is not None:
+        add(dict(partition), name)
+      else:
+        add(fetch._merge_params(target.get('custom_params'), partition), name)
+  return streams, tables, filters
+
+def api2db_multi(api_spec, db_spec, targets, maxrows=None,
+                 partitions=None, max_workers=4,
+                 load_method=db.EXECUTEMANY, load_batch_size=None,
+                 transform_workers=0, transform_chunk_size=500,
+                 transform_engine=ROW_ENGINE, load_mode=DIRECT_LOAD,
+                 load_workers=None, cache_dir=None, replay=None,
+                 fetch_retries=FETCH_RETRIES, fetch_engine=THREAD_FETCH,
+                 page_size=None, on_loaded=None):
+  '''
+  api2db for several target tables at once. targets is a list of maps
+  with 'db_table_name' and 'custom_params' (as for api2db), and optionally
+  'load_method', 'load_batch_size' and 'load_mode' overriding the
+  arguments of the same name for that table.
+
+  The union of the targets' participants is fetched and transformed once.
+  Targets filtering only on who participants are paired with (e.g.
+  {'organization': 'COLUMBIA_WEILL'}; see _local_filter) share a single
+  paging stream of the whole awardee, and each of their rows is routed
+  by its record's fields. Any other target's custom_params are paged as
+  a stream of their own, so that the API does the filtering, and that
+  target gets the rows its stream returned. With partitions, each of
+  these streams is split as in api2db (see _target_streams). The targets
+  are then loaded concurrently, load_workers (default: all) at a time.
+  The whole dataset is held in memory, as in api2db without batch_size.
+  cache_dir, replay, fetch_retries, fetch_engine and page_size are as
+  for api2db; a replayed run must have been fetched for the same targets
+  and partitions, or this raises rather than load a table without its
+  rows. on_loaded, if given, is called with each db_table_name as soon
+  as that table has loaded (on the thread that loaded it).
+
+  Returns a map of db_table_name to number of rows loaded.
+  '''
+  streams, tables, filters = _target_streams(api_spec, targets, partitions)
+  # participantId -> keys of the streams that returned it, and the keys
+  # of all streams that returned any page. Filled from the fetch threads.
+  seen = collections.defaultdict(set)
+  fetched = set()
+  lock = threading.Lock()
+
+  def tag(bundle, key):
+    with lock:
+      fetched.add(key)
+      for rcd in c.rcds_from_bundle(bundle):
+        seen[rcd.get('participantId')].add(key)
+
+  rcds = []
+  for page in _iter_api_pages(api_spec, None, maxrows,
+                              streams, max_workers, cache_dir, replay,
+                              fetch_retries, fetch_engine, page_size,
+                              on_bundle=tag):
+    rcds.extend(page)
+  metrics.mark(metrics.FETCHED)
+  hp_rows = []
+  for rows in _hp_pages([rcds], transform_workers,
+                        transform_chunk_size, engine=transform_engine):
+    hp_rows.extend(rows)
+  metrics.mark(metrics.TRANSFORMED)
+
+  routed = {target['db_table_name']: [] for target in targets}
+  with lock:
+    # Without maxrows every stream returns at least one page.
+    missing = [key for key in tables if key not in fetched]
+    if missing and not maxrows:
+      raise Exception('No pages for stream(s) {}{}'.format(
+        ', '.join(missing), ' in cached run ' + replay if replay else ''))
+    for rcd, row in zip(rcds, hp_rows):
+      names = set()
+      for key in seen[rcd.get('participantId')]:
+        for name in tables.get(key, ()):
+          local = filters.get(name)
+          if local is None or all(rcd.get(k) == v for k, v in local.items()):
+            names.add(name)
+      for name in names:
+        routed[name].append(row)
+
+  def load(target):
+    name = target['db_table_name']
+    _load_table(db_spec, name, routed[name],
+                target.get('load_method', load_method),
+                target.get('load_batch_size', load_batch_size),
+                target.get('load_mode', load_mode))
+    if on_loaded:
+      on_loaded(name)
+
+  with ThreadPoolExecutor(max_workers=load_workers or len(targets)) as pool:
+    # list() so a failed load raises here.
+    list(pool.map(load, targets))
+  metrics.mark(metrics.LOADED)
+  return {name: len(rows) for name, rows in routed.items()}
+
+#------------------------------------------------------------------------------
+# incremental refresh
+
+def _load_state(path):
+  if not path or not os.path.exists(path):
+    return None
+  return slurpj(path)
+
+def _save_state(path, state):
+  tmp = path + '.tmp'
+  spit(tmp, json.dumps(state).encode('utf-8'))
+  os.replace(tmp, path)
+
+def _get_modified(api_spec, sess, retries):
+  '''Map of participantId to lastModified, from ParticipantSummary/Modified.'''
+  out = {}
+  for r in c.get_pmi_ids(api_spec, sess, retries):
+    if not r.get('participantId'):
+      raise Exception('ParticipantSummary/Modified returned a record '
+                      'without participantId: ' + str(r)[:200])
+    out[r['participantId']] = r['lastModified']
+  return out
+
+def _modified_since(modified, pids):
+  '''lastModified query param covering every participant in pids, from
+  their lastModified in modified (see _get_modified), at second
+  precision.'''
+  return 'ge' + min(modified[pid] for pid in pids)[:19]
+
+def api2db_incremental(api_spec, db_spec, db_table_name, custom_params,
+                       state_path, max_workers=4, **kwargs):
+  '''
+  Incremental version of api2db. Uses ParticipantSummary/Modified to find
+  participants whose lastModified differs from the state file at
+  state_path (a JSON map of participantId to lastModified kept from the
+  previous run), then pages through ParticipantSummary with custom_params
+  and lastModified at or after the earliest of those, so that the API
+  applies the filter, and MERGEs what it returns into db_table_name
+  through a staging table. Participants no longer in
+  ParticipantSummary/Modified, or changed but not returned for
+  custom_params, are deleted. Active Retention Date is then recalculated
+  for the whole table, since it depends on today's date. The MERGE and
+  deletes match on KEY_COLUMN, which gets an index (KEY_INDEX) the first
+  time they run after a full load.
+
+  Falls back to a full api2db (passing kwargs along) when there is no
+  state file yet or the table doesn't exist. Requests are retried as
+  api2db's are (kwargs' fetch_retries), and kwargs' fetch_engine and
+  page_size apply; partitions and the page cache are only used by a full
+  refresh. Any request that still fails fails the run. The state file is
+  only written once the fetch and the load have succeeded. kwargs may not
+  include maxrows: the state file records every participant, so a
+  partial load would never be completed.
+
+  Returns a map with the number of rows upserted and deleted, or None if
+  a full refresh was done.
+  '''
+  if kwargs.get('maxrows'):
+    raise Exception('maxrows can\'t be used with an incremental refresh.')
+  begin_dt = active_retention_date.window_start()
+  retries = kwargs.get('fetch_retries', FETCH_RETRIES)
+  sess = fetch.authed_session(api_spec, 1)
+  modified = _get_modified(api_spec, sess, retries)
+  state = _load_state(state_path)
+  if state is None or not db.db_table_does_exist(db_spec, db_table_name):
+    api2db(api_spec, db_spec, db_table_name, custom_params,
+           max_workers=max_workers, **kwargs)
+    _save_state(state_path, modified)
+    return None
+
+  changed = [pid for pid, lm in modified.items() if state.get(pid) != lm]
+  gone = [pid for pid in state if pid not in modified]
+  rcds = []
+  if changed:
+    params = fetch._merge_params(
+      custom_params, {'lastModified': _modified_since(modified, changed)})
+    for page in _iter_api_pages(api_spec, params, None, None, max_workers,
+                                retries=retries,
+                                engine=kwargs.get('fetch_engine',
+                                                  THREAD_FETCH),
+                                page_size=kwargs.get('page_size')):
+      rcds.extend(page)
+  metrics.mark(metrics.FETCHED)
+  kept = {r['participantId'] for r in rcds}
+  drop_ids = gone + [pid for pid in changed if pid not in kept]
+
+  if rcds or drop_ids:
+    with metrics.stage(metrics.DDL):
+      db.db_stmt(db_spec, db.ddl_create_index_if_missing(
+                            db_table_name, KEY_INDEX, [KEY_COLUMN]))
+  if rcds:
+    hp_rows = _transform_chunk(rcds, begin_dt,
+                               kwargs.get('transform_engine', ROW_ENGINE))
+    metrics.mark(metrics.TRANSFORMED)
+    # Unique per run, so that concurrent runs (or the leftovers of a
+    # crashed one) don't share it.
+    stage_name = db.fqtn_with_suffix(
+      db_table_name, '_incr_{}_{}'.format(os.getpid(), int(time.time())))
+    try:
+      _recreate_table(db_spec, stage_name)
+      _insert(db_spec, stage_name, hp_rows,
+              kwargs.get('load_method', db.EXECUTEMANY),
+              kwargs.get('load_batch_size'))
+      with metrics.stage(metrics.LOAD):
+        db.db_stmt(db_spec, db.ddl_merge(db_table_name, stage_name,
+                                         KEY_COLUMN, list(hp_rows[0])))
+    finally:
+      db.db_drop_table(db_spec,
+                       db.db_schema_name_from_fqtn(stage_name),
+                       db.db_table_from_fqtn(stage_name))
+  if drop_ids:
+    db.db_delete_keys(db_spec, db_table_name, KEY_COLUMN, drop_ids)
+  with metrics.stage(metrics.RETENTION):
+    active_retention_date.refresh_column(db_spec, db_table_name, begin_dt)
+  metrics.mark(metrics.LOADED)
+
+  _save_state(state_path, modified)
+  return {'upserted': len(rcds), 'deleted': len(drop_ids)}
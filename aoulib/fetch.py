@@ -0,0 +1,496 @@
+import json
+import zlib
+import time
+import queue
+import logging
+import random
+import asyncio
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import core as c
+from . import metrics
+from .utils import (SCOPES, TRANSIENT_HTTP_STATUSES, TransientHTTPError,
+                    loads_json, page_sizer, request_timeout)
+
+'''
+Concurrent paging for the ParticipantSummary API.
+
+core.iter-pages follows the continuation links one request at a time.
+The helpers here hide that latency:
+
+  - prefetch() keeps the next page(s) of any page generator in flight on
+    a background thread while the caller works on the current page.
+  - iter_pages_partitioned() splits the query into independent streams
+    (see org_partitions and last_modified_partitions), pages through them
+    on a bounded thread pool and merges the results, de-duplicated by
+    participantId.
+  - AsyncRDRClient does the same on asyncio, for many streams (awardees,
+    organizations, ...) in one thread; iter_pages_async runs it for
+    synchronous callers.
+
+Every response is logged at INFO to this module's logger, with its size
+on the wire and decoded (refresh.py writes these to its log).
+'''
+
+log = logging.getLogger(__name__)
+
+def _log_page(url, status, wire, size, secs):
+  log.info('HTTP %s, %d bytes on the wire (%d decoded), %.2fs: %s',
+           status, wire, size, secs, url)
+
+def _log_response(resp, *args, **kwargs):
+  if log.isEnabledFor(logging.INFO):
+    size, wire = metrics.response_sizes(resp)
+    _log_page(resp.url, resp.status_code, wire, size,
+              resp.elapsed.total_seconds())
+
+def authed_session(api_spec, pool_size=None):
+  '''core.make-authed-session-obj, with the access token fetched up front
+  (timed as metrics.AUTH), responses counted toward metrics.FETCH and
+  logged. pool_size is how many threads will share the session (default:
+  requests' pool).'''
+  with metrics.stage(metrics.AUTH):
+    sess = c.make_authed_session_obj(api_spec, pool_size)
+    if hasattr(sess, 'credentials'):
+      from google.auth.transport.requests import Request
+      sess.credentials.refresh(Request())
+  sess.hooks['response'].append(_log_response)
+  return metrics.instrument_session(sess)
+
+# Marks the end of a producer's output on a queue.
+_DONE = object()
+
+class _Failure:
+  'Wraps an exception raised on a producer thread.'
+  def __init__(self, ex):
+    self.ex = ex
+
+def _put(q, item, stop):
+  '''Put item on a bounded queue unless the consumer has gone away.
+  Returns False if we should stop producing.'''
+  while not stop.is_set():
+    try:
+      q.put(item, timeout=0.5)
+      return True
+    except queue.Full:
+      continue
+  return False
+
+def prefetch(pages, depth=1):
+  '''Generator; yields the items of the `pages` iterable, which is consumed
+  on a background thread that stays up to `depth` items ahead of us.
+  Exceptions raised while producing are re-raised here.'''
+  q = queue.Queue(maxsize=depth)
+  stop = threading.Event()
+
+  def produce():
+    try:
+      for page in pages:
+        if not _put(q, page, stop):
+          return
+      _put(q, _DONE, stop)
+    except Exception as ex:
+      _put(q, _Failure(ex), stop)
+
+  th = threading.Thread(target=produce, daemon=True)
+  th.start()
+  yield from _drain(q, stop)
+
+def _drain(q, stop):
+  '''Generator; yields the items a producer thread puts on q until _DONE,
+  re-raising a _Failure. Sets stop once done or abandoned.'''
+  try:
+    while True:
+      item = q.get()
+      if item is _DONE:
+        break
+      if isinstance(item, _Failure):
+        raise item.ex
+      yield item
+  finally:
+    stop.set()
+
+def org_partitions(orgs):
+  '''One partition per organization, e.g. ['COLUMBIA_WEILL', ...].'''
+  return [{'organization': org} for org in orgs]
+
+def last_modified_partitions(start, end, n):
+  '''
+  Splits the lastModified range into n partitions with n-1 cut points
+  evenly spaced between start and end (datetime objects). The first
+  partition is open below and the last open above, so together they cover
+  every participant.
+
+  Note: a participant modified while the fetch is running can move between
+  partitions; it is de-duplicated if seen twice, but can be missed if it
+  moves into a partition that has already been read. Prefer
+  org_partitions where possible.
+  '''
+  if n < 2:
+    return [{}]
+  step = (end - start) / n
+  cuts = [(start + step * i).strftime('%Y-%m-%dT%H:%M:%S')
+          for i in range(1, n)]
+  out = [{'lastModified': 'lt' + cuts[0]}]
+  for lo, hi in zip(cuts, cuts[1:]):
+    out.append({'lastModified': ['ge' + lo, 'lt' + hi]})
+  out.append({'lastModified': 'ge' + cuts[-1]})
+  return out
+
+def stream_key(params):
+  '''Identifies a paging stream by its query params; see
+  iter_pages_partitioned's resume.'''
+  return json.dumps(params or {}, sort_keys=True)
+
+def _merge_params(custom_params, partition):
+  '''custom_params narrowed by a partition's query params. Raises if the
+  partition sets a param custom_params already does, since it would
+  replace that filter rather than narrow it.'''
+  clash = sorted(set(custom_params or {}) & set(partition))
+  if clash:
+    raise ValueError('Partition {} sets params already in {}: {}'.format(
+      partition, custom_params, ', '.join(clash)))
+  params = dict(custom_params or {})
+  params.update(partition)
+  return params
+
+def iter_pages_partitioned(api_spec, partitions, custom_params=None,
+                           max_workers=4, maxrows=None, depth=2,
+                           on_bundle=None, resume=None, retries=0):
+  '''
+  Generator; like core.iter-pages but runs one paging stream per entry in
+  `partitions` (each a map of query params merged over custom_params) on
+  a pool of max_workers threads, each with its own authorized session.
+  Pages are yielded as they arrive, in no particular order, with any
+  participantId already seen dropped. At most max_workers * depth pages
+  are buffered.
+
+  on_bundle, if given, is called with each raw bundle and the stream's
+  key (see stream_key), from the pool's threads. resume maps stream keys
+  to the continuation URL to start that stream from, or to None if the
+  stream already finished; streams not in it start from the first page.
+  retries is passed to core.iter-pages.
+  '''
+  q = queue.Queue(maxsize=max(1, max_workers * depth))
+  stop = threading.Event()
+
+  def produce(partition):
+    try:
+      params = _merge_params(custom_params, partition)
+      key = stream_key(params)
+      resume_url = (resume or {}).get(key)
+      if resume and key in resume and resume_url is None:
+        _put(q, _DONE, stop)
+        return
+      cb = (lambda bundle: on_bundle(bundle, key)) if on_bundle else None
+      sess = authed_session(api_spec, 1)
+      for page in c.iter_pages(api_spec, sess, params, maxrows, cb,
+                               resume_url, retries):
+        if not _put(q, page, stop):
+          return
+      _put(q, _DONE, stop)
+    except Exception as ex:
+      _put(q, _Failure(ex), stop)
+
+  seen = set()
+  pending = len(partitions)
+  pool = ThreadPoolExecutor(max_workers=max_workers)
+  try:
+    for partition in partitions:
+      pool.submit(produce, partition)
+    while pending:
+      item = q.get()
+      if item is _DONE:
+        pending -= 1
+        continue
+      if isinstance(item, _Failure):
+        raise item.ex
+      page = []
+      for rcd in item:
+        pid = rcd.get('participantId')
+        if pid in seen:
+          continue
+        seen.add(pid)
+        page.append(rcd)
+      if page:
+        yield page
+      if maxrows and len(seen) >= maxrows:
+        break
+  finally:
+    stop.set()
+    pool.shutdown(wait=False)
+
+#------------------------------------------------------------------------------
+# asyncio
+
+# The background refresh renews the access token this many seconds before
+# it expires (google-auth tokens last an hour).
+TOKEN_REFRESH_MARGIN = 300
+
+# Seconds an idle pooled connection is kept open by AsyncRDRClient.
+KEEPALIVE_SECS = 60
+
+# Backoff between retries of a page request, as in utils.with_retries.
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+class _AsyncToken:
+  '''
+  The service account's access token for AsyncRDRClient: fetched on
+  start(), then renewed by a background task TOKEN_REFRESH_MARGIN seconds
+  before it expires. With no key file there is no token (and requests
+  are unauthenticated, e.g. against bench/mockrdr.py).
+  '''
+  def __init__(self, key_file):
+    self.key_file = key_file
+    self.creds = None
+    self.task = None
+
+  async def _refresh(self):
+    # google-auth is synchronous; keep its HTTP call off the event loop.
+    from google.auth.transport.requests import Request
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, self.creds.refresh, Request())
+
+  async def _keep_fresh(self):
+    while True:
+      wait = TOKEN_REFRESH_MARGIN
+      if self.creds.expiry:
+        left = (self.creds.expiry - datetime.datetime.utcnow()).total_seconds()
+        wait = max(left - TOKEN_REFRESH_MARGIN, 1)
+      await asyncio.sleep(wait)
+      try:
+        await self._refresh()
+      except Exception:
+        # The current token may still be good; headers() refreshes inline
+        # if it isn't by the time it's needed.
+        await asyncio.sleep(RETRY_BASE_DELAY)
+
+  async def start(self):
+    if not self.key_file:
+      return
+    from google.oauth2 import service_account # from google-auth
+    self.creds = service_account.Credentials.from_service_account_file(
+                   self.key_file, scopes=SCOPES)
+    with metrics.stage(metrics.AUTH):
+      await self._refresh()
+    self.task = asyncio.ensure_future(self._keep_fresh())
+
+  async def headers(self):
+    if self.creds is None:
+      return {}
+    if not self.creds.valid:
+      await self._refresh()
+    return {'Authorization': 'Bearer ' + self.creds.token}
+
+  async def stop(self):
+    if self.task:
+      self.task.cancel()
+      await asyncio.gather(self.task, return_exceptions=True)
+
+def _first_url(api_spec, params):
+  '''core.bld-records-url; an 'awardee' in params replaces api_spec's, so
+  that one client can page through several awardees.'''
+  params = dict(params or {})
+  if 'awardee' in params:
+    api_spec = dict(api_spec, awardee=params.pop('awardee'))
+  return c.bld_records_url(api_spec, params)
+
+class AsyncRDRClient:
+  '''
+  asyncio counterpart of an authorized session plus core.iter-pages,
+  built on aiohttp (an optional dependency: pip install aiohttp).
+
+      async with fetch.AsyncRDRClient(api_spec, concurrency=8) as client:
+        async for page in client.iter_pages_partitioned(partitions):
+          ...
+
+  One connection pool and one access token (see _AsyncToken) are shared
+  by every stream, and at most `concurrency` requests are in flight at a
+  time. Pages are fetched as for the threaded helpers above, so the same
+  partitions, pagecache callbacks and resume maps work with both; a
+  partition may also set 'awardee' to page through another awardee than
+  api_spec's. Each response counts toward metrics.FETCH (timed to the end
+  of its body) and is logged. gzip is asked for, and the bodies
+  decompressed here so that their size on the wire is known. A
+  "page-size" of utils.ADAPTIVE in api_spec works as for core.iter-pages.
+  timeout defaults to api_spec's "request-timeout" (see
+  utils.request_timeout).
+  '''
+  def __init__(self, api_spec, concurrency=4, timeout=None):
+    self.api_spec = api_spec
+    self.concurrency = concurrency
+    self.timeout = timeout or request_timeout(api_spec)
+    self.token = _AsyncToken(api_spec.get('path-to-key-file'))
+    self.session = None
+
+  async def __aenter__(self):
+    import aiohttp
+    self.transient = (TransientHTTPError,
+                      aiohttp.ClientConnectionError,
+                      aiohttp.ClientPayloadError,
+                      asyncio.TimeoutError)
+    self.sem = asyncio.Semaphore(self.concurrency)
+    self.session = aiohttp.ClientSession(
+      connector=aiohttp.TCPConnector(limit=self.concurrency,
+                                     keepalive_timeout=KEEPALIVE_SECS),
+      timeout=aiohttp.ClientTimeout(total=self.timeout),
+      headers={'Accept-Encoding': 'gzip'},
+      auto_decompress=False)
+    try:
+      await self.token.start()
+    except BaseException:
+      await self.session.close()
+      raise
+    return self
+
+  async def __aexit__(self, *exc):
+    await self.token.stop()
+    await self.session.close()
+
+  async def _get_json(self, url):
+    async with self.sem:
+      start = time.perf_counter()
+      async with self.session.get(url,
+                                  headers=await self.token.headers()) as resp:
+        if resp.status in TRANSIENT_HTTP_STATUSES:
+          raise TransientHTTPError('HTTP {} from {}'.format(resp.status, url))
+        resp.raise_for_status()
+        gunzip = (zlib.decompressobj(16 + zlib.MAX_WBITS)
+                  if resp.headers.get('Content-Encoding') == 'gzip' else None)
+        body = await resp.read()
+        wire = len(body)
+        if gunzip:
+          body = gunzip.decompress(body) + gunzip.flush()
+        size = len(body)
+        bundle = loads_json(body)
+      secs = time.perf_counter() - start
+    metrics.add(metrics.FETCH, secs, bytes=size, wire_bytes=wire)
+    _log_page(url, resp.status, wire, size, secs)
+    return bundle
+
+  async def get_json(self, url, retries=0):
+    '''Fetches and decodes url, retrying transient failures (connection
+    errors, timeouts, TRANSIENT_HTTP_STATUSES) up to retries times with
+    randomized exponential backoff. Other HTTP errors are raised.'''
+    for attempt in range(retries + 1):
+      try:
+        return await self._get_json(url)
+      except self.transient:
+        if attempt >= retries:
+          raise
+        await asyncio.sleep(random.uniform(
+          0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+
+  async def iter_pages(self, params=None, maxrows=None, on_bundle=None,
+                       start_url=None, retries=0):
+    '''Async generator; core.iter-pages over this client.'''
+    url = start_url or _first_url(self.api_spec, params)
+    sizer = page_sizer(self.api_spec)
+    n = 0
+    while url:
+      if sizer:
+        url = sizer.apply(url)
+      start = time.perf_counter()
+      bundle = await self.get_json(url, retries)
+      if not bundle:
+        break
+      if on_bundle:
+        on_bundle(bundle)
+      rcds = c.rcds_from_bundle(bundle)
+      if sizer:
+        sizer.observe(time.perf_counter() - start, len(rcds))
+      n += len(rcds)
+      yield rcds
+      url = (c.next_page_url(bundle) if not maxrows or n < maxrows
+             else None)
+
+  async def iter_pages_partitioned(self, partitions, custom_params=None,
+                                   maxrows=None, depth=2, on_bundle=None,
+                                   resume=None, retries=0):
+    '''
+    Async generator; iter_pages_partitioned over this client. Every
+    partition is paged concurrently (requests being limited by the
+    client's concurrency), with up to depth pages per partition buffered.
+    '''
+    q = asyncio.Queue(maxsize=max(1, len(partitions) * depth))
+
+    async def produce(partition):
+      try:
+        params = _merge_params(custom_params, partition)
+        key = stream_key(params)
+        resume_url = (resume or {}).get(key)
+        if not (resume and key in resume and resume_url is None):
+          cb = (lambda bundle: on_bundle(bundle, key)) if on_bundle else None
+          async for page in self.iter_pages(params, maxrows, cb, resume_url,
+                                            retries):
+            await q.put(page)
+        await q.put(_DONE)
+      except Exception as ex:
+        await q.put(_Failure(ex))
+
+    tasks = [asyncio.ensure_future(produce(p)) for p in partitions]
+    seen = set()
+    pending = len(partitions)
+    try:
+      while pending:
+        item = await q.get()
+        if item is _DONE:
+          pending -= 1
+          continue
+        if isinstance(item, _Failure):
+          raise item.ex
+        page = []
+        for rcd in item:
+          pid = rcd.get('participantId')
+          if pid in seen:
+            continue
+          seen.add(pid)
+          page.append(rcd)
+        if page:
+          yield page
+        if maxrows and len(seen) >= maxrows:
+          break
+    finally:
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+
+def iter_pages_async(api_spec, partitions=None, custom_params=None,
+                     concurrency=4, maxrows=None, depth=2, on_bundle=None,
+                     resume=None, retries=0):
+  '''
+  Generator for synchronous callers (e.g. etl); AsyncRDRClient's
+  iter_pages_partitioned, run on an event loop on a background thread.
+  Without partitions, pages through custom_params as one stream. Takes the
+  same arguments as iter_pages_partitioned, concurrency standing in for
+  max_workers.
+  '''
+  q = queue.Queue(maxsize=max(1, depth))
+  stop = threading.Event()
+
+  async def run():
+    async with AsyncRDRClient(api_spec, concurrency) as client:
+      pages = client.iter_pages_partitioned(partitions or [{}], custom_params,
+                                            maxrows, depth, on_bundle,
+                                            resume, retries)
+      try:
+        loop = asyncio.get_event_loop()
+        async for page in pages:
+          # Wait for room on q without blocking the loop.
+          if not await loop.run_in_executor(None, _put, q, page, stop):
+            return
+      finally:
+        await pages.aclose()
+
+  def produce():
+    try:
+      asyncio.run(run())
+      _put(q, _DONE, stop)
+    except Exception as ex:
+      _put(q, _Failure(ex), stop)
+
+  th = threading.Thread(target=produce, daemon=True)
+  th.start()
+  yield from _drain(q, stop)
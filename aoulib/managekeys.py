@@ -2,9 +2,6 @@ import os
 import base64
 import json
 import datetime
-from google.oauth2 import service_account # from google-auth
-import googleapiclient.discovery # from google-api-python-client
-from . import core as c
 from .utils import *
 
 def _build_full_key_name(api_spec, private_key_id):
@@ -21,15 +18,41 @@ def _build_full_key_name(api_spec, private_key_id):
 def _id_from_key_name(key_name):
   return key_name[key_name.rfind('/')+1:]
 
+# IAM v1's discovery document, shipped with aoulib (a copy of the one
+# google-api-python-client 2.x bundles) so that building the IAM resource
+# doesn't fetch it from Google every time.
+IAM_DISCOVERY_DOC = os.path.join(os.path.dirname(__file__), 'iam.v1.json')
+
+# Key file path -> (mtime, credentials, IAM resource), so that the key
+# file is read and the resource built once per process -- or again once
+# the file has been replaced (as cycle_keys does).
+_svc_cache = {}
+
+def _cached(api_spec):
+  '''Returns (credentials, IAM resource) for api_spec's key file.'''
+  path = os.path.abspath(api_spec['path-to-key-file'])
+  mtime = os.stat(path).st_mtime_ns
+  hit = _svc_cache.get(path)
+  if hit is not None and hit[0] == mtime:
+    return hit[1:]
+  # Imported here so that keycycle.py etc. start without these.
+  from google.oauth2 import service_account # from google-auth
+  import googleapiclient.discovery # from google-api-python-client
+  creds = service_account.Credentials.from_service_account_file(
+            filename=path, scopes=SCOPES)
+  with open(IAM_DISCOVERY_DOC) as f:
+    svc = googleapiclient.discovery.build_from_document(f.read(),
+                                                        credentials=creds)
+  _svc_cache[path] = (mtime, creds, svc)
+  return creds, svc
+
 def get_key_id(api_spec):
   '''Returns the private key ID of key file specified by api_spec'''
-  return slurpj(api_spec['path-to-key-file'])['private_key_id']
+  return _cached(api_spec)[0].signer.key_id
 
 def _make_svc(api_spec):
   '''Returns an object of type googleapiclient.discovery.Resource.'''
-  creds = service_account.Credentials.from_service_account_file(
-            filename=api_spec['path-to-key-file'], scopes=c.SCOPES)
-  return googleapiclient.discovery.build('iam', 'v1', credentials=creds)
+  return _cached(api_spec)[1]
 
 def list_keys(api_spec, detailed=False):
   '''Returns list of key IDs. If detailed is True,
@@ -91,9 +114,8 @@ def cycle_keys(api_spec):
   4. Writes a new key file (same name as what was current).
   Returns a map containing the old and new key IDs.
   '''
+  old_private_key_id = get_key_id(api_spec)
   new_key_info = create_key(api_spec)
-  old_private_key_id = slurpj(
-                          api_spec['path-to-key-file'])['private_key_id']
   os.rename(api_spec['path-to-key-file'], api_spec['path-to-key-file'] + '.old')
   key_file_data = base64.b64decode(new_key_info['privateKeyData'])
   spit(api_spec['path-to-key-file'], key_file_data)
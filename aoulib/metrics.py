@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import datetime
+import threading
+import contextlib
+try:
+  import resource
+except ImportError:
+  # Windows has no resource module; peak memory is then left out.
+  resource = None
+
+'''
+Per-stage timing and throughput of a refresh run.
+
+    run = metrics.RunMetrics()
+    with metrics.recording(run):
+      etl.api2db(...)
+    run.finish()
+    log.info(run.to_json())
+
+The library reports into whichever run is being recorded:
+
+    with metrics.stage(metrics.LOAD, rows=len(rows)):
+      ...
+    metrics.add(metrics.FETCH, rows=len(page), calls=0)
+
+Both are no-ops when nothing is recording (or in a transform pool worker),
+so callers that don't care pay nothing.
+
+A stage's figures are totals over all its calls and threads: with several
+fetch streams, or fetch overlapping transform and load, stage seconds can
+add up to more than the run's wall time. Fetch seconds are per HTTP
+request (time to the response headers; see instrument_session); bytes
+are response body sizes after decompression, and wire_bytes the sizes
+as received, before decompression. peak_rss_mb is the process's peak
+resident memory as of the stage's last call.
+'''
+
+AUTH = 'auth'
+FETCH = 'fetch'
+TRANSFORM = 'transform'
+RETENTION = 'retention'
+DDL = 'ddl'
+LOAD = 'load'
+AGENT_JOB = 'agent_job'
+
+def _peak_rss_bytes():
+  if resource is None:
+    return None
+  # ru_maxrss is in KB on Linux.
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class RunMetrics:
+  '''
+  Totals per stage for one run. observers, if given, are called as
+  observer(event, name) with event 'start' or 'end' around each stage()
+  block, and 'mark' at each mark(), e.g. to profile stages; calls to
+  add() aren't observed.
+  '''
+  def __init__(self, observers=()):
+    self.pid = os.getpid()
+    self.started = datetime.datetime.now()
+    self.finished = None
+    self.observers = list(observers)
+    self.stages = {}
+    self.lock = threading.Lock()
+    self._start = time.perf_counter()
+    self._end = None
+
+  def add(self, name, secs=0.0, rows=0, bytes=0, calls=1, wire_bytes=0):
+    peak = _peak_rss_bytes()
+    with self.lock:
+      st = self.stages.get(name)
+      if st is None:
+        st = self.stages[name] = {'calls': 0, 'secs': 0.0, 'max_secs': 0.0,
+                                  'rows': 0, 'bytes': 0, 'wire_bytes': 0,
+                                  'peak_rss': None}
+      st['calls'] += calls
+      st['secs'] += secs
+      st['max_secs'] = max(st['max_secs'], secs)
+      st['rows'] += rows
+      st['bytes'] += bytes
+      st['wire_bytes'] += wire_bytes
+      if peak is not None:
+        st['peak_rss'] = max(st['peak_rss'] or 0, peak)
+
+  def finish(self):
+    if self._end is None:
+      self._end = time.perf_counter()
+      self.finished = datetime.datetime.now()
+
+  def wall_secs(self):
+    return (self._end or time.perf_counter()) - self._start
+
+  def to_dict(self):
+    '''Summary of the run so far, JSON-ready.'''
+    def mb(x):
+      return None if x is None else round(x / 1048576, 1)
+    with self.lock:
+      stages = {name: {'calls': st['calls'],
+                       'secs': round(st['secs'], 3),
+                       'max_secs': round(st['max_secs'], 3),
+                       'rows': st['rows'],
+                       'bytes': st['bytes'],
+                       'wire_bytes': st['wire_bytes'],
+                       'rows_per_sec': (round(st['rows'] / st['secs'], 1)
+                                        if st['rows'] and st['secs']
+                                        else None),
+                       'peak_rss_mb': mb(st['peak_rss'])}
+                for name, st in self.stages.items()}
+    return {'started': self.started.isoformat(timespec='seconds'),
+            'finished': (self.finished.isoformat(timespec='seconds')
+                         if self.finished else None),
+            'wall_secs': round(self.wall_secs(), 3),
+            'peak_rss_mb': mb(_peak_rss_bytes()),
+            'stages': stages}
+
+  def to_json(self):
+    return json.dumps(self.to_dict(), separators=(',', ':'))
+
+_active = None
+
+def current():
+  '''The run being recorded in this process, or None.'''
+  run = _active
+  # A forked transform worker inherits _active; its figures would be lost
+  # (and its copy of the lock may be held), so it records nothing.
+  if run is None or run.pid != os.getpid():
+    return None
+  return run
+
+@contextlib.contextmanager
+def recording(run=None):
+  '''Records stages into run (a new RunMetrics by default) until the block
+  exits. Yields the run. A run can be recorded into more than once; call
+  its finish() at the end.'''
+  global _active
+  run = run or RunMetrics()
+  prev, _active = _active, run
+  try:
+    yield run
+  finally:
+    _active = prev
+
+def add(name, secs=0.0, rows=0, bytes=0, calls=1, wire_bytes=0):
+  '''Adds to stage name's totals in the current run, if any.'''
+  run = current()
+  if run is not None:
+    run.add(name, secs, rows, bytes, calls, wire_bytes)
+
+class _Stage:
+  'What stage() yields; rows can be set inside the block.'
+  def __init__(self, rows):
+    self.rows = rows
+
+@contextlib.contextmanager
+def stage(name, rows=0):
+  '''Times the block as one call of stage name (see add). Yields an
+  object whose .rows can be set once the row count is known.'''
+  run = current()
+  st = _Stage(rows)
+  if run is None:
+    yield st
+    return
+  for observer in run.observers:
+    observer('start', name)
+  start = time.perf_counter()
+  try:
+    yield st
+  finally:
+    run.add(name, time.perf_counter() - start, st.rows)
+    for observer in run.observers:
+      observer('end', name)
+
+# Checkpoints passed to mark() once a whole dataset has been fetched,
+# transformed or loaded (never reached when api2db streams in batches,
+# except LOADED).
+FETCHED = 'fetched'
+TRANSFORMED = 'transformed'
+LOADED = 'loaded'
+
+def mark(name):
+  '''Tells the current run's observers, if any, that checkpoint name was
+  reached.'''
+  run = current()
+  if run is not None:
+    for observer in run.observers:
+      observer('mark', name)
+
+def response_sizes(resp):
+  '''(body bytes, bytes on the wire) of a requests response.'''
+  size = len(resp.content)
+  try:
+    # What urllib3 read from the socket, before decompression.
+    wire = resp.raw.tell()
+  except Exception:
+    wire = size
+  return size, wire
+
+def _on_response(resp, *args, **kwargs):
+  run = current()
+  if run is not None:
+    size, wire = response_sizes(resp)
+    run.add(FETCH, resp.elapsed.total_seconds(), bytes=size, wire_bytes=wire)
+
+def instrument_session(sess):
+  '''Counts every response sess receives toward FETCH (see the module
+  docstring) through a requests response hook. Returns sess.'''
+  sess.hooks['response'].append(_on_response)
+  return sess
+
+#------------------------------------------------------------------------------
+# Prometheus
+
+def prometheus_text(run, success=True, prefix='aou_refresh'):
+  '''The run in the Prometheus text exposition format.'''
+  d = run.to_dict()
+  lines = []
+  def metric(name, help_, samples):
+    lines.append('# HELP {}_{} {}'.format(prefix, name, help_))
+    lines.append('# TYPE {}_{} gauge'.format(prefix, name))
+    for labels, value in samples:
+      if value is None:
+        continue
+      label_str = ('{' + ','.join('{}="{}"'.format(k, v)
+                                  for k, v in labels.items()) + '}'
+                   if labels else '')
+      lines.append('{}_{}{} {}'.format(prefix, name, label_str, value))
+  stages = d['stages']
+  def per_stage(key):
+    return [({'stage': name}, st[key]) for name, st in sorted(stages.items())]
+  metric('success', 'Whether the last run succeeded.',
+         [({}, 1 if success else 0)])
+  metric('last_run_timestamp_seconds', 'When the last run finished.',
+         [({}, round(time.time()))])
+  metric('wall_seconds', 'Wall time of the last run.',
+         [({}, d['wall_secs'])])
+  metric('peak_rss_bytes', 'Peak resident memory of the last run.',
+         [({}, None if d['peak_rss_mb'] is None
+               else round(d['peak_rss_mb'] * 1048576))])
+  metric('stage_seconds', 'Time spent in each stage (summed over threads).',
+         per_stage('secs'))
+  metric('stage_calls', 'Calls (e.g. page requests) per stage.',
+         per_stage('calls'))
+  metric('stage_rows', 'Rows handled per stage.', per_stage('rows'))
+  metric('stage_bytes', 'Bytes received per stage.', per_stage('bytes'))
+  metric('stage_wire_bytes',
+         'Bytes received per stage, before decompression.',
+         per_stage('wire_bytes'))
+  metric('stage_rows_per_second', 'Rows per second per stage.',
+         per_stage('rows_per_sec'))
+  return '\n'.join(lines) + '\n'
+
+def write_textfile(run, path, success=True):
+  '''Writes prometheus_text to path atomically, for node_exporter's
+  textfile collector.'''
+  tmp = path + '.tmp'
+  with open(tmp, 'w') as f:
+    f.write(prometheus_text(run, success))
+  os.replace(tmp, path)
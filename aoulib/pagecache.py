@@ -0,0 +1,281 @@
+import os
+import json
+import gzip
+import shutil
+import datetime
+import threading
+from . import core as c
+
+'''
+On-disk cache of raw ParticipantSummary bundles, so a run can be replayed
+(e.g. after a transform or database failure, or to profile the later
+stages) without going back to the API.
+
+Each run gets a directory under the cache directory, named after its
+start time:
+
+  <cache_dir>/<run>/manifest.json   run info; "complete" once the fetch
+                                    finished without error, or
+                                    "truncated" if it stopped at
+                                    "maxrows" with pages left
+  <cache_dir>/<run>/pages.jsonl.gz  one bundle per line, with the key of
+                                    the paging stream it came from
+                                    (fetch.stream_key), each appended as
+                                    its own gzip member, so a run that
+                                    dies part way leaves a readable file
+  <cache_dir>/<run>/checkpoint.json continuation URL of each paging stream
+                                    after its last saved bundle
+
+A fetch that fails part way can be resumed from checkpoint.json (see
+find_resumable); the resumed fetch writes pages.1.jsonl.gz, and so on.
+
+Truncated runs (test loads with maxrows) are only a sample of the
+source, so they are never resumed, replayed as LATEST, or counted
+toward the runs prune_runs keeps; they can still be replayed by name.
+'''
+
+MANIFEST = 'manifest.json'
+PAGES = 'pages.jsonl.gz'
+CHECKPOINT = 'checkpoint.json'
+LATEST = 'latest'
+
+# Incomplete runs older than this are fetched again from scratch rather
+# than resumed (their continuation URLs and data are likely stale).
+RESUME_MAX_AGE_HOURS = 12
+
+def _write_json(path, obj):
+  tmp = path + '.tmp'
+  with open(tmp, 'w') as f:
+    json.dump(obj, f, indent=1)
+  os.replace(tmp, path)
+
+def read_manifest(cache_dir, run):
+  with open(os.path.join(cache_dir, run, MANIFEST)) as f:
+    return json.load(f)
+
+def read_checkpoint(cache_dir, run):
+  path = os.path.join(cache_dir, run, CHECKPOINT)
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    return json.load(f)
+
+def _segments(run_dir):
+  '''Page files of a run, in the order they were written.'''
+  def seq(name):
+    return int(name.split('.')[1]) if name.count('.') == 3 else 0
+  return sorted((name for name in os.listdir(run_dir)
+                 if name.startswith('pages.') and name.endswith('.jsonl.gz')),
+                key=seq)
+
+def _same_source(a, b):
+  return json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)
+
+def _truncated(cache_dir, run):
+  return read_manifest(cache_dir, run).get('truncated', False)
+
+def find_resumable(cache_dir, source):
+  '''The newest run that isn't truncated if it is an incomplete fetch of
+  the same source (see PageCacheWriter), younger than
+  RESUME_MAX_AGE_HOURS, with a checkpoint; otherwise None.'''
+  runs = [r for r in list_runs(cache_dir, complete_only=False)
+          if not _truncated(cache_dir, r)]
+  if not runs:
+    return None
+  run = runs[-1]
+  manifest = read_manifest(cache_dir, run)
+  started = datetime.datetime.fromisoformat(manifest['started'])
+  age = datetime.datetime.now() - started
+  if (manifest.get('complete')
+      or not _same_source(manifest.get('source'), source)
+      or age > datetime.timedelta(hours=RESUME_MAX_AGE_HOURS)
+      or not read_checkpoint(cache_dir, run)):
+    return None
+  return run
+
+def list_runs(cache_dir, complete_only=True):
+  '''Run names in cache_dir, oldest first. Truncated runs aren't
+  complete.'''
+  if not os.path.isdir(cache_dir):
+    return []
+  runs = sorted(d for d in os.listdir(cache_dir)
+                if os.path.exists(os.path.join(cache_dir, d, MANIFEST)))
+  if complete_only:
+    runs = [r for r in runs if read_manifest(cache_dir, r).get('complete')]
+  return runs
+
+def resolve_run(cache_dir, run):
+  '''run, or the newest complete run if run is LATEST.'''
+  if run != LATEST:
+    return run
+  runs = list_runs(cache_dir)
+  if not runs:
+    raise Exception('No complete runs in page cache ' + cache_dir)
+  return runs[-1]
+
+def prune_runs(cache_dir, keep, include_truncated=False):
+  '''Deletes all runs older than the newest `keep` runs (complete or
+  not). Truncated runs only count toward `keep` with include_truncated,
+  so test loads don't push out full runs; those newer than the oldest
+  run kept are kept too.'''
+  runs = list_runs(cache_dir, complete_only=False)
+  counted = [r for r in runs
+             if include_truncated or not _truncated(cache_dir, r)]
+  kept = counted[-keep:] if keep else []
+  if keep and not kept:
+    return
+  for run in runs:
+    if kept and run == kept[0]:
+      break
+    shutil.rmtree(os.path.join(cache_dir, run))
+
+class PageCacheWriter:
+  '''
+  Appends bundles to a new run in cache_dir, or with resume=True, to the
+  existing run `run` (see find_resumable). append() is thread-safe, so it
+  can be used as the on_bundle callback of fetch.iter_pages_partitioned.
+  `source` and `maxrows` (the row limit of the fetch, if any) are
+  recorded in the manifest.
+
+  After each bundle is written, checkpoint.json is updated with the
+  stream's next continuation URL (None once the stream is finished). A
+  bundle whose checkpoint wasn't saved is fetched again on resume; the
+  duplicate rows are dropped by dedup_pages.
+  '''
+  def __init__(self, cache_dir, source=None, run=None, resume=False,
+               maxrows=None):
+    self.run = run or datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+    self.dir = os.path.join(cache_dir, self.run)
+    if resume:
+      self.manifest = read_manifest(cache_dir, self.run)
+      self.checkpoint = read_checkpoint(cache_dir, self.run)
+      self.manifest['maxrows'] = maxrows
+      pages = 'pages.{}.jsonl.gz'.format(len(_segments(self.dir)))
+    else:
+      os.makedirs(self.dir)
+      self.manifest = {'run': self.run,
+                       'started': datetime.datetime.now().isoformat(),
+                       'source': source,
+                       'maxrows': maxrows,
+                       'complete': False,
+                       'truncated': False,
+                       'pages': 0,
+                       'rows': 0}
+      self.checkpoint = {'streams': {}, 'pages': 0, 'rows': 0}
+      pages = PAGES
+    self.lock = threading.Lock()
+    self.f = open(os.path.join(self.dir, pages), 'ab')
+    _write_json(os.path.join(self.dir, MANIFEST), self.manifest)
+
+  def streams(self):
+    '''Map of stream key to continuation URL (None if finished), for
+    fetch.iter_pages_partitioned's resume.'''
+    return dict(self.checkpoint['streams'])
+
+  def append(self, bundle, stream=''):
+    data = gzip.compress(
+      (json.dumps({'stream': stream, 'bundle': bundle},
+                  separators=(',', ':')) + '\n').encode('utf-8'))
+    with self.lock:
+      if self.f.closed:
+        # Prefetched past the point where the consumer stopped.
+        return
+      self.f.write(data)
+      self.f.flush()
+      self.checkpoint['streams'][stream] = c.next_page_url(bundle)
+      self.checkpoint['pages'] += 1
+      self.checkpoint['rows'] += len(bundle.get('entry', []))
+      _write_json(os.path.join(self.dir, CHECKPOINT), self.checkpoint)
+
+  def close(self, complete=True, truncated=False):
+    with self.lock:
+      if self.f.closed:
+        return
+      self.f.close()
+      self.manifest['pages'] = self.checkpoint['pages']
+      self.manifest['rows'] = self.checkpoint['rows']
+      self.manifest['complete'] = complete
+      self.manifest['truncated'] = truncated
+      self.manifest['finished'] = datetime.datetime.now().isoformat()
+      _write_json(os.path.join(self.dir, MANIFEST), self.manifest)
+
+  def _pages_left(self):
+    with self.lock:
+      return any(self.checkpoint['streams'].values())
+
+  def wrap(self, pages):
+    '''Generator; yields pages, closing the cache once they are exhausted
+    as complete, or as truncated if the fetch stopped at maxrows with
+    pages left; as incomplete if fetching fails or the consumer stops
+    early.'''
+    exhausted = False
+    try:
+      for page in pages:
+        yield page
+      exhausted = True
+    finally:
+      truncated = (exhausted and bool(self.manifest.get('maxrows'))
+                   and self._pages_left())
+      self.close(exhausted and not truncated, truncated)
+
+def _read_segment(path):
+  '''Generator; (stream key, bundle) for each line of a page file.'''
+  with gzip.open(path, 'rt', encoding='utf-8') as f:
+    try:
+      for line in f:
+        item = json.loads(line)
+        yield item['stream'], item['bundle']
+    except EOFError:
+      # Last page of an interrupted fetch was cut short.
+      return
+
+def _iter_stream_bundles(cache_dir, run):
+  run_dir = os.path.join(cache_dir, run)
+  paths = [os.path.join(run_dir, name) for name in _segments(run_dir)]
+  return (item for path in paths for item in _read_segment(path))
+
+def iter_bundles(cache_dir, run):
+  '''Iterator over the bundles cached for run (see resolve_run). Only
+  the page files that exist when this is called are read.'''
+  return (bundle for _, bundle in _iter_stream_bundles(cache_dir, run))
+
+def dedup_pages(pages, maxrows=None):
+  '''Generator; pages of records with any participantId already seen
+  dropped, stopping at the first page boundary past maxrows (if given).'''
+  seen = set()
+  for rcds in pages:
+    page = []
+    for rcd in rcds:
+      pid = rcd.get('participantId')
+      if pid in seen:
+        continue
+      seen.add(pid)
+      page.append(rcd)
+    yield page
+    if maxrows and len(seen) >= maxrows:
+      break
+
+def iter_cached_pages(cache_dir, run, maxrows=None, allow_incomplete=False,
+                      on_bundle=None):
+  '''
+  Replays a cached run like core.iter-pages: returns an iterator over the
+  list of records in each bundle, de-duplicated by participantId (partitioned
+  fetches can see a participant twice). run may be LATEST. Refuses runs
+  whose fetch didn't complete unless allow_incomplete, or the run is a
+  truncated one asked for by name. on_bundle, if given, is called with
+  each cached bundle and its stream key as it is read, like the
+  on_bundle of fetch.iter_pages_partitioned.
+  '''
+  run = resolve_run(cache_dir, run)
+  manifest = read_manifest(cache_dir, run)
+  if not (allow_incomplete or manifest.get('complete')
+          or manifest.get('truncated')):
+    raise Exception('Cached run {} is incomplete'.format(run))
+  def bundles(items):
+    for stream, bundle in items:
+      if on_bundle:
+        on_bundle(bundle, stream)
+      yield bundle
+  items = _iter_stream_bundles(cache_dir, run)
+  pages = (c.rcds_from_bundle(b) for b in bundles(items))
+  return dedup_pages(pages, maxrows)
@@ -0,0 +1,134 @@
+import os
+import io
+import pstats
+import cProfile
+import datetime
+import threading
+import tracemalloc
+
+'''
+Profilers for a refresh run, driven by the metrics module's observer
+hooks (see metrics.RunMetrics):
+
+    prof = profiling.make_profiler(profiling.CPU)
+    run = metrics.RunMetrics(observers=[prof])
+    with metrics.recording(run):
+      etl.api2db(...)
+    prof.write(out_dir)
+
+CPU keeps one cProfile per stage (plus OTHER for time between stages)
+and writes each as a .pstats file (for pstats, snakeviz, etc.) and all
+of them, sorted by cumulative time, to one .txt file. Only the main
+thread is profiled: work on fetch and load threads shows up as time
+spent waiting for them.
+
+MEM traces allocations with tracemalloc and takes a snapshot at each
+metrics.mark() (after the fetch, transform and load), writing the top
+allocation sites of each, the growth since the previous snapshot, and
+the traced peak to one .txt file.
+
+Both slow the run down noticeably; combine with refresh.py's --maxrows
+for a quick sample.
+'''
+
+CPU = 'cpu'
+MEM = 'mem'
+MODES = [CPU, MEM]
+
+# Main-thread time not inside any stage() block.
+OTHER = 'other'
+
+# Lines of stats per stage / snapshot in the .txt files.
+TOP = 40
+
+def _stamp():
+  return datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+
+def _on_main_thread():
+  return threading.current_thread() is threading.main_thread()
+
+class CpuProfiler:
+  def __init__(self):
+    self.profiles = {}
+    # Stages currently open on the main thread, innermost last.
+    self.stack = [OTHER]
+    self._profile(OTHER).enable()
+
+  def _profile(self, name):
+    if name not in self.profiles:
+      self.profiles[name] = cProfile.Profile()
+    return self.profiles[name]
+
+  def __call__(self, event, name):
+    if event == 'mark' or not _on_main_thread():
+      return
+    self._profile(self.stack[-1]).disable()
+    if event == 'start':
+      self.stack.append(name)
+    elif len(self.stack) > 1:
+      self.stack.pop()
+    self._profile(self.stack[-1]).enable()
+
+  def stop(self):
+    self._profile(self.stack[-1]).disable()
+
+  def write(self, out_dir, prefix='profile'):
+    '''Writes <prefix>-<time>-cpu-<stage>.pstats per stage and
+    <prefix>-<time>-cpu.txt; returns the .txt path.'''
+    self.stop()
+    base = os.path.join(out_dir, '{}-{}-cpu'.format(prefix, _stamp()))
+    out = io.StringIO()
+    for name, prof in self.profiles.items():
+      prof.dump_stats('{}-{}.pstats'.format(base, name))
+      out.write('=' * 78 + '\nStage: {}\n'.format(name))
+      stats = pstats.Stats(prof, stream=out)
+      stats.sort_stats('cumulative').print_stats(TOP)
+    with open(base + '.txt', 'w') as f:
+      f.write(out.getvalue())
+    return base + '.txt'
+
+class MemProfiler:
+  def __init__(self, frames=1):
+    self.snapshots = []
+    tracemalloc.start(frames)
+
+  def __call__(self, event, name):
+    if event == 'mark':
+      self.snapshots.append((name, tracemalloc.take_snapshot(),
+                             tracemalloc.get_traced_memory()))
+
+  def stop(self):
+    if tracemalloc.is_tracing():
+      if not self.snapshots:
+        # Failed before the first checkpoint; keep what there is.
+        self('mark', 'stopped')
+      tracemalloc.stop()
+
+  def write(self, out_dir, prefix='profile'):
+    '''Writes <prefix>-<time>-mem.txt; returns its path.'''
+    self.stop()
+    path = os.path.join(out_dir, '{}-{}-mem.txt'.format(prefix, _stamp()))
+    prev = None
+    with open(path, 'w') as f:
+      for name, snap, (current, peak) in self.snapshots:
+        f.write('=' * 78 + '\n')
+        f.write('After: {}  traced now: {:.1f} MB  peak so far: {:.1f} MB\n\n'
+                ''.format(name, current / 1048576, peak / 1048576))
+        f.write('Top allocation sites:\n')
+        for stat in snap.statistics('lineno')[:TOP]:
+          f.write('  {}\n'.format(stat))
+        if prev is not None:
+          f.write('\nGrowth since previous snapshot:\n')
+          for stat in snap.compare_to(prev, 'lineno')[:TOP]:
+            f.write('  {}\n'.format(stat))
+        f.write('\n')
+        prev = snap
+    return path
+
+def make_profiler(mode):
+  '''A CpuProfiler or MemProfiler for mode (CPU or MEM), started.'''
+  if mode == CPU:
+    return CpuProfiler()
+  if mode == MEM:
+    return MemProfiler()
+  raise ValueError('Unknown profile mode: ' + str(mode))
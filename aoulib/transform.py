@@ -1,10 +1,14 @@
+import re
 import sys
-import dateutil.parser
+import datetime
+import functools
+import itertools
+import collections.abc
 import pytz
 
 # See notes at bottom of file.
 
-__all__ = ['into_hp_row']
+__all__ = ['into_hp_row', 'into_hp_columns', 'columns_to_dicts']
 
 #------------------------------------------------------------------------------
 # utilities
@@ -248,29 +252,61 @@ def api2hp_completed_or_0(x):
   if x == '': return '0'
   else: return out
 
+# Target timezone for datetimes; see api2hp_datetime.
+TZ_EASTERN = pytz.timezone('US/Eastern')
+
+# The shapes RDR actually sends: 'YYYY-MM-DD' and
+# 'YYYY-MM-DDThh:mm:ss[.ffffff][Z]'.
+_rdr_datetime_re = re.compile(r'(\d{4})-(\d\d)-(\d\d)'
+                              r'(?:T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?)?Z?$')
+
+def parse_api_datetime(x):
+  '''Parses an API date/datetime string into a naive datetime. RDR's
+  fixed ISO-8601 shapes are handled directly; anything else falls back to
+  dateutil.'''
+  m = _rdr_datetime_re.match(x)
+  if not m:
+    import dateutil.parser
+    return dateutil.parser.parse(x)
+  y, mo, d, h, mi, sec, frac = m.groups()
+  if h is None:
+    return datetime.datetime(int(y), int(mo), int(d))
+  return datetime.datetime(int(y), int(mo), int(d), int(h), int(mi), int(sec),
+                           int(frac.ljust(6, '0')) if frac else 0)
+
+# Many participants share the same consent/survey timestamps, so the
+# formatted results are memoized.
+@functools.lru_cache(maxsize=65536)
+def _hp_date(x):
+  return parse_api_datetime(x).strftime('%m/%d/%Y')
+
+@functools.lru_cache(maxsize=65536)
+def _hp_datetime(x):
+  dt_obj = parse_api_datetime(x)
+  dt_obj = dt_obj.replace(tzinfo=pytz.utc)
+  # Next line does the following:
+  # - shift timezone from UTC to Eastern
+  # - format into the almost (but not quite) the desired HP style datetime format.
+  return dt_obj.astimezone(tz=TZ_EASTERN).strftime('%m/%d/%Y %I:%M %p')
+  # If you wanted you could also use the version below in order to:
+  # - remove leading zero from hour portion
+  # - change "AM" / "PM" to "am" / "pm" with lower()
+  # return dt_obj.astimezone(tz=TZ_EASTERN).strftime('%m/%d/%Y %I:%M %p').replace(' 0', ' ').lower()
+
 def api2hp_date(x):
   '''yyyy-MM-dd into dd/MM/yyyy'''
   if not x or x.strip() == '': return ''
-  return dateutil.parser.parse(x).strftime('%m/%d/%Y')
+  return _hp_date(x)
 
 def api2hp_datetime(x):
   '''yyyy-MM-ddThh:mm:ss into dd/MM/yyyy [h]h:mm {am|pm}
   We convert from UTC to our timezone b/c that's what HP does.
-  Note that target tz of US/Eastern is hardcoded here (change if desired).
+  Note that target tz of US/Eastern is hardcoded here (change TZ_EASTERN if
+  desired).
   We don't completely match (HP also strips leading zero from month
   and day) but close enough.'''
   if not x or x.strip() == '': return ''
-  dt_obj = dateutil.parser.parse(x)
-  dt_obj = dt_obj.replace(tzinfo=pytz.utc)
-  tz_eastern = pytz.timezone('US/Eastern')
-  # Next line does the following:
-  # - shift timezone from UTC to Eastern
-  # - format into the almost (but not quite) the desired HP style datetime format.
-  return dt_obj.astimezone(tz=tz_eastern).strftime('%m/%d/%Y %I:%M %p')
-  # If you wanted you could also use the version below in order to:
-  # - remove leading zero from hour portion
-  # - change "AM" / "PM" to "am" / "pm" with lower()
-  # return dt_obj.astimezone(tz=tz_eastern).strftime('%m/%d/%Y %I:%M %p').replace(' 0', ' ').lower()
+  return _hp_datetime(x)
 
 def api2hp_language(x):
   '''Converts API-style language string into full name of language.
@@ -555,6 +591,38 @@ def determine_consent_cohort(api_row):
         return ht.get(consentCohort, '')
 
 
+#------------------------------------------------------------------------------
+# compiled plan
+
+def _identity(x):
+  return x
+
+def compile_plan(mappings):
+  '''Resolves a one-to-one mapping table into a flat list of
+  (hp_key, api_key, func) tuples, so converters are looked up by name once
+  rather than for every row. Mappings without a 'func' pass values through.'''
+  return [(m['hp'],
+           m['api'],
+           str2func(m['func']) if m.get('func', '*') != '*' else _identity)
+          for m in mappings]
+
+def compile_pairs(mappings):
+  '''Pairs up the one-to-many mapping table as
+  (status_hp_key, time_hp_key, status_api_keys, time_api_keys) tuples.'''
+  return [(mappings[i]['hp'], mappings[i + 1]['hp'],
+           mappings[i]['api'], mappings[i + 1]['api'])
+          for i in range(0, len(mappings), 2)]
+
+# Built once at import; call refresh_plans() if the mapping tables are
+# changed at runtime.
+plan_one_to_one = compile_plan(mappings_one_to_one)
+plan_one_to_many = compile_pairs(mappings_one_to_many)
+
+def refresh_plans():
+  global plan_one_to_one, plan_one_to_many
+  plan_one_to_one = compile_plan(mappings_one_to_one)
+  plan_one_to_many = compile_pairs(mappings_one_to_many)
+
 #------------------------------------------------------------------------------
 # driver
 
@@ -562,31 +630,19 @@ def into_hp_row(api_row):
   '''
   If a value is missig in api_row, using empty string (e.g., address2).
   '''
-  out = {}
   # First, handle one-to-one mappings (which are most of them).
-  for mapping in mappings_one_to_one:
-    api_val = api_row.get(mapping['api'], '')
-    hp_val = ''
-    if mapping.get('func', '*') != '*':
-      hp_val = str2func(mapping['func'])(api_val)
-    else:
-      hp_val = api_val
-    out[mapping['hp']] = hp_val
+  get = api_row.get
+  out = {hp_key: func(get(api_key, ''))
+         for hp_key, api_key, func in plan_one_to_one}
 
   # Then, handle one-to-many items.
   # Note: we're handling two at a time -- the value and time
   # need to be processed as a pair (time field depends on value field we 
   # choose.)
-  i = 0
-  while i < len(mappings_one_to_many):
-    hp_val = ''
-    status, time = api2hp_mult_sample_resolve(
-                        api_row,
-                        mappings_one_to_many[i]['api'], # list of status field names
-                        mappings_one_to_many[i + 1]['api']) # list of time field names
-    out[mappings_one_to_many[i]['hp']] = status
-    out[mappings_one_to_many[i + 1]['hp']] = time
-    i += 2
+  for status_key, time_key, status_fields, time_fields in plan_one_to_many:
+    status, time = api2hp_mult_sample_resolve(api_row, status_fields, time_fields)
+    out[status_key] = status
+    out[time_key] = time
   
   # Sal order
   sal_order_status_col_name = 'Saliva Sample Order Status'
@@ -601,6 +657,141 @@ def into_hp_row(api_row):
   #done
   return out
 
+#------------------------------------------------------------------------------
+# columnar engine
+
+@functools.lru_cache(maxsize=65536)
+def _eastern_offset(y, mo, d, h):
+  '''UTC offset of TZ_EASTERN during the UTC hour y-mo-d h:00. US/Eastern
+  only changes offset on the hour (UTC), so this holds for the whole hour.'''
+  utc_hour = pytz.utc.localize(datetime.datetime(y, mo, d, h))
+  return utc_hour.astimezone(TZ_EASTERN).utcoffset()
+
+def _hp_datetimes(values):
+  '''
+  Bulk api2hp_datetime: returns a map of each distinct value in values to
+  its HP datetime. Each value is parsed once, and the shift to US/Eastern
+  is one offset lookup per UTC hour (see _eastern_offset) plus datetime
+  arithmetic, rather than a pytz conversion and strftime per value.
+  Values the RDR pattern doesn't cover go through api2hp_datetime.
+  Unhashable values (e.g. lists) are left out; see _map_datetimes.
+  '''
+  values = list(values)
+  try:
+    distinct = set(values)
+  except TypeError:
+    distinct = {x for x in values if isinstance(x, collections.abc.Hashable)}
+  out = {}
+  for x in distinct:
+    m = _rdr_datetime_re.match(x) if x else None
+    if not m:
+      out[x] = api2hp_datetime(x)
+      continue
+    y, mo, d, h, mi, sec, frac = m.groups()
+    y, mo, d, h = int(y), int(mo), int(d), int(h or 0)
+    dt_obj = (datetime.datetime(y, mo, d, h, int(mi or 0), int(sec or 0),
+                                int(frac.ljust(6, '0')) if frac else 0)
+              + _eastern_offset(y, mo, d, h))
+    if dt_obj.year < 1000:
+      # strftime doesn't zero-pad these years.
+      out[x] = _hp_datetime(x)
+      continue
+    hour = dt_obj.hour
+    out[x] = '%02d/%02d/%04d %02d:%02d %s' % (
+      dt_obj.month, dt_obj.day, dt_obj.year, hour % 12 or 12, dt_obj.minute,
+      'PM' if hour >= 12 else 'AM')
+  return out
+
+def _map_datetimes(lookup, values):
+  '''values through lookup, a _hp_datetimes result. Unhashable values
+  (e.g. an empty participantIncentives list) go through api2hp_datetime
+  one by one, as in into_hp_row.'''
+  try:
+    return list(map(lookup.__getitem__, values))
+  except TypeError:
+    return [lookup[v] if isinstance(v, collections.abc.Hashable)
+            else api2hp_datetime(v) for v in values]
+
+def _map_column(func, values):
+  '''[func(v) for v in values], calling func once per distinct value
+  (statuses and codebook values repeat a lot).'''
+  try:
+    lookup = {v: func(v) for v in set(values)}
+  except TypeError:
+    # Unhashable values (e.g. lists).
+    return [func(v) for v in values]
+  return list(map(lookup.__getitem__, values))
+
+def into_hp_columns(api_rows):
+  '''
+  Column-wise into_hp_row for a page (or whole dataset) of API rows.
+  Returns a map of HP column name to a list with one value per row, with
+  the columns in into_hp_row's order; see columns_to_dicts for rows.
+
+  Each API field is pulled out of the rows once. Converters run once per
+  distinct value in their column, and every datetime in the page (the
+  one-to-one datetime columns and the sample times) is converted in one
+  pass over its distinct values (see _hp_datetimes).
+  '''
+  n = len(api_rows)
+  extracted = {}
+  def column(api_key):
+    if api_key not in extracted:
+      extracted[api_key] = [r.get(api_key, '') for r in api_rows]
+    return extracted[api_key]
+
+  # One-to-many pairs: the time of the first RECEIVED status, found by
+  # going through the status fields last to first.
+  pairs = []
+  for status_key, time_key, status_fields, time_fields in plan_one_to_many:
+    status = ['0'] * n
+    raw_time = [''] * n
+    for status_field, time_field in zip(reversed(status_fields),
+                                        reversed(time_fields)):
+      times = column(time_field)
+      for i, v in enumerate(column(status_field)):
+        if v == 'RECEIVED':
+          status[i] = '1'
+          raw_time[i] = times[i]
+    pairs.append((status_key, time_key, status, raw_time))
+
+  hp_datetime = _hp_datetimes(itertools.chain(
+    itertools.chain.from_iterable(column(api_key)
+                                  for _, api_key, func in plan_one_to_one
+                                  if func is api2hp_datetime),
+    itertools.chain.from_iterable(raw_time for *_, raw_time in pairs)))
+
+  out = {}
+  for hp_key, api_key, func in plan_one_to_one:
+    values = column(api_key)
+    if func is _identity:
+      out[hp_key] = list(values)
+    elif func is api2hp_datetime:
+      out[hp_key] = _map_datetimes(hp_datetime, values)
+    else:
+      out[hp_key] = _map_column(func, values)
+  for status_key, time_key, status, raw_time in pairs:
+    out[status_key] = status
+    out[time_key] = _map_datetimes(hp_datetime, raw_time)
+
+  out['Saliva Sample Order Status'] = [
+    sal2 if sal2 not in ('*', 'UNSET') else sal
+    for sal2, sal in zip([r.get('sampleOrderStatus1SAL2', '*')
+                          for r in api_rows],
+                         column('sampleOrderStatus1SAL'))]
+
+  cohort_keys = ('consentCohort', 'cohort2PilotFlag')
+  out['Consent Cohort'] = _map_column(
+    lambda pair: determine_consent_cohort(dict(zip(cohort_keys, pair))),
+    list(zip(column('consentCohort'), column('cohort2PilotFlag'))))
+  return out
+
+def columns_to_dicts(cols):
+  '''Column map (see into_hp_columns) into a list of maps, one per row,
+  as into_hp_row returns them.'''
+  keys = list(cols)
+  return [dict(zip(keys, row)) for row in zip(*cols.values())]
+
 #------------------------------------------------------------------------------
 '''
 
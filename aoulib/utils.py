@@ -1,10 +1,20 @@
 import os
 import logging
 from logging.handlers import RotatingFileHandler
-from email.message import EmailMessage
-import smtplib 
 import json
+import time
+import random
 import datetime
+try:
+    # Optional; several times faster than json at decoding API pages.
+    import orjson
+except ImportError:
+    orjson = None
+
+# OAuth scopes for the service account (see core.make-authed-session-obj
+# and managekeys).
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform",
+          "https://www.googleapis.com/auth/userinfo.email"]
 
 def slurpj(fname):
   with open(fname) as f:
@@ -14,12 +24,19 @@ def spit(fname, bytes):
   with open(fname, 'wb') as f:
     f.write(bytes)
 
+class _LazyRotatingFileHandler(RotatingFileHandler):
+    '''Creates the log directory and file on the first record logged
+    rather than when the logger is made (usually at import time).'''
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, delay=True, **kwargs)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
 def smart_logger(tag='default', logdir='./log', __cache__={}):
     if not tag:
         raise ValueError('tag needs to be a non-empty string')
-    # make logdir if needed
-    if not os.path.exists(logdir):
-        os.makedirs(logdir)
     # return pre-existing logger if exists
     if tag in __cache__:
         return __cache__[tag]
@@ -27,9 +44,9 @@ def smart_logger(tag='default', logdir='./log', __cache__={}):
         x = logging.getLogger(tag)
         x.setLevel(logging.INFO)
         logpath = logdir + os.path.sep + tag + '.log'
-        handler = RotatingFileHandler(logpath,
-                                      maxBytes=33554432,
-                                      backupCount=16)
+        handler = _LazyRotatingFileHandler(logpath,
+                                           maxBytes=33554432,
+                                           backupCount=16)
         fmt = logging.Formatter('[%(asctime)s] [%(levelname)s] '
                                 '[%(filename)s:%(lineno)s %(funcName)s] '
                                 '%(message)s')
@@ -39,6 +56,8 @@ def smart_logger(tag='default', logdir='./log', __cache__={}):
         return x
 
 def send_email(*, frm=None, to=None, subj=None, body=None):
+    from email.message import EmailMessage
+    import smtplib
     em = EmailMessage()
     em['From'] = frm
     em['To'] = to
@@ -52,3 +71,142 @@ def today_as_str():
   '''Current date as a string: yyyy-mm-dd'''
   return datetime.date.today().strftime("%Y-%m-%d")
 
+#------------------------------------------------------------------------------
+# retries
+
+# HTTP statuses worth retrying: rate limiting and server/gateway errors.
+TRANSIENT_HTTP_STATUSES = (429, 500, 502, 503, 504)
+
+class TransientHTTPError(Exception):
+    pass
+
+def check_status(resp):
+    '''Returns resp if it succeeded. Raises TransientHTTPError (which
+    with_retries retries) if its status is one of TRANSIENT_HTTP_STATUSES,
+    and requests' HTTPError for any other error status, as
+    fetch.AsyncRDRClient does.'''
+    if resp.status_code in TRANSIENT_HTTP_STATUSES:
+        raise TransientHTTPError('HTTP {} from {}'.format(
+            resp.status_code, getattr(resp, 'url', '?')))
+    resp.raise_for_status()
+    return resp
+
+def transient_errors():
+    '''Exceptions with_retries retries by default. A function so that
+    importing this module doesn't import requests.'''
+    import requests
+    return (TransientHTTPError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError)
+
+def with_retries(fn, retries=0, base_delay=1.0, max_delay=60.0,
+                 transient=None):
+    '''
+    Returns fn(). If it raises one of `transient` (default:
+    transient_errors()), tries again, up to `retries` more times, sleeping
+    a random time between 0 and base_delay * 2**attempt seconds (capped at
+    max_delay) in between, so that parallel streams don't retry in
+    lockstep.
+    '''
+    transient = transient or transient_errors()
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except transient:
+            if attempt >= retries:
+                raise
+            time.sleep(random.uniform(0, min(max_delay,
+                                             base_delay * 2 ** attempt)))
+
+#------------------------------------------------------------------------------
+# JSON decoding
+
+def loads_json(data):
+    '''Decodes JSON from bytes (or str), with orjson if it's installed.
+    Decoding bytes directly avoids making a str copy of a large body.'''
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+#------------------------------------------------------------------------------
+# paging and HTTP transport
+
+# Records per ParticipantSummary page, unless the api spec's "page-size"
+# says otherwise.
+PAGE_SIZE = 100
+
+# "page-size" value for a page size that adapts to the API's latency; see
+# PageSizer.
+ADAPTIVE = 'adaptive'
+
+# Limits of an adaptive page size, and the response time it aims below.
+MAX_PAGE_SIZE = 1000
+PAGE_TARGET_SECS = 5.0
+
+# Seconds an API request may take, unless the api spec's
+# "request-timeout" says otherwise. A stalled connection then fails (and
+# is retried) instead of hanging the run.
+REQUEST_TIMEOUT = 300
+
+def request_timeout(spec):
+    '''The timeout, in seconds, of each request for an api spec.'''
+    return float(spec.get('request-timeout') or REQUEST_TIMEOUT)
+
+def page_count(spec):
+    '''The count of the first page requested for an api spec.'''
+    size = spec.get('page-size')
+    if size is None or size == ADAPTIVE:
+        return PAGE_SIZE
+    return int(size)
+
+def with_page_size(url, size):
+    '''url (a ParticipantSummary page URL, e.g. a continuation link) with
+    its count set to size.'''
+    from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if k != 'count']
+    query.append(('count', str(size)))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+class PageSizer:
+    '''
+    Adaptive page size for one paging stream. Starts at PAGE_SIZE and
+    doubles (up to max_size) after each full page that came back within
+    target_secs; halves (down to PAGE_SIZE) after a page that took more
+    than twice that. Bigger pages mean fewer round trips, as long as the
+    API keeps answering quickly.
+    '''
+    def __init__(self, max_size=MAX_PAGE_SIZE, target_secs=PAGE_TARGET_SECS):
+        self.size = PAGE_SIZE
+        self.max_size = max_size
+        self.target_secs = target_secs
+
+    def observe(self, secs, rows):
+        '''Adjusts the size after a page of rows records took secs.'''
+        if rows >= self.size and secs <= self.target_secs:
+            self.size = min(self.size * 2, self.max_size)
+        elif secs > 2 * self.target_secs:
+            self.size = max(self.size // 2, PAGE_SIZE)
+
+    def apply(self, url):
+        return with_page_size(url, self.size)
+
+def page_sizer(spec):
+    '''A PageSizer if the api spec's "page-size" is ADAPTIVE, else None.'''
+    return PageSizer() if spec.get('page-size') == ADAPTIVE else None
+
+def tune_session(sess, pool_size=None):
+    '''
+    Sizes a requests session's connection pool to the pool_size threads
+    that will share it, so none of them has to reconnect (requests keeps
+    10 connections per host). Without pool_size, sess is left as it is.
+    Returns sess.
+    '''
+    if pool_size:
+        from requests.adapters import HTTPAdapter
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        sess.mount('https://', adapter)
+        sess.mount('http://', adapter)
+    return sess
@@ -0,0 +1,79 @@
+import sys
+import os
+import re
+import time
+import argparse
+import subprocess
+
+'''
+# bench_import.py
+
+Cold-start cost of the CLIs' imports, measured with `python -X importtime`
+in a fresh interpreter per target:
+
+    python bench/bench_import.py [--runs 5] [--top 15] [target ...]
+
+Targets are Python statements; by default, what keycycle.py and
+refresh.py import before doing any work, and a first use of core. For
+each, prints the median wall time of the interpreter run and the total
+import time, then the modules with the largest cumulative import time
+(from the last run).
+
+Run it once beforehand (or after installdeps.sh) so bytecode, including
+core.hy's, is cached; the first run after a change includes compiling.
+'''
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+TARGETS = {
+  'keycycle': 'import aoulib as aou; from aoulib.utils import *; '
+              'aou.managekeys',
+  'refresh': 'import aoulib as aou; import aoulib.db as s; '
+             'from aoulib.utils import *',
+  'etl': 'import aoulib.etl',
+  'core': 'import aoulib.core',
+}
+
+_line_re = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def measure(stmt):
+  '''Returns (wall secs, [(cumulative us, self us, module)]) for one fresh
+  interpreter running stmt.'''
+  env = dict(os.environ, PYTHONPATH=REPO)
+  start = time.perf_counter()
+  proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', stmt],
+                        env=env, cwd=REPO, stderr=subprocess.PIPE,
+                        universal_newlines=True, check=True)
+  wall = time.perf_counter() - start
+  mods = []
+  for line in proc.stderr.splitlines():
+    m = _line_re.match(line)
+    if m:
+      mods.append((int(m.group(2)), int(m.group(1)), m.group(4)))
+  return wall, mods
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('targets', nargs='*',
+                      help='names from TARGETS or Python statements')
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--top', type=int, default=15)
+  args = parser.parse_args()
+  for target in args.targets or list(TARGETS):
+    stmt = TARGETS.get(target, target)
+    walls = []
+    for _ in range(args.runs):
+      wall, mods = measure(stmt)
+      walls.append(wall)
+    walls.sort()
+    total_us = sum(self_us for _, self_us, _ in mods)
+    print('=' * 78)
+    print('{}: {}'.format(target, stmt))
+    print('wall (median of {}): {:.3f}s   imports: {:.3f}s   modules: {}'
+          ''.format(args.runs, walls[len(walls) // 2], total_us / 1e6,
+                    len(mods)))
+    print('{:>10} {:>10}  {}'.format('cumul ms', 'self ms', 'module'))
+    for cumul, self_us, name in sorted(mods, reverse=True)[:args.top]:
+      print('{:>10.1f} {:>10.1f}  {}'.format(cumul / 1e3, self_us / 1e3, name))
+
+if __name__ == '__main__': main()
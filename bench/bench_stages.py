@@ -0,0 +1,196 @@
+import sys
+import os
+import json
+import time
+import argparse
+import resource
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+import synth
+import mockrdr
+
+'''
+# bench_stages.py
+
+Rows/sec and peak RSS of each refresh stage at several dataset sizes,
+using synthetic participants (synth.py) served by a local mock RDR
+(mockrdr.py), so no credentials or network access are needed.
+
+    python bench/bench_stages.py [--sizes 10000,100000,1000000]
+                                 [--stages fetch,transform,pipeline]
+                                 [--latency 0.05] [--fetch-workers 4]
+                                 [--fetch-engine threads|asyncio]
+                                 [--page-size 100|adaptive]
+                                 [--transform-engine row|columnar]
+                                 [--db-spec enclave/p04.json --db-table ...]
+
+Stages:
+  fetch      page through the mock API (etl._iter_api_pages); records are
+             counted and dropped.
+  transform  etl._transform_chunk (into_hp_row + Active Retention Date)
+             over synthetic pages of 100; only the transform is timed.
+  pipeline   fetch and transform together, as api2db streams them
+             (etl._hp_pages), without a database.
+  api2db     etl.api2db end to end, streaming in batches; only run when
+             --db-spec and --db-table are given. The table is dropped
+             and recreated.
+
+Each stage and size runs in its own process, so peak RSS is the stage's
+own; "base" is the peak before the stage started (imports, and for
+transform the synth.RecordPool). The mock server runs in this process.
+'''
+
+STAGES = ['fetch', 'transform', 'pipeline', 'api2db']
+PAGE_SIZE = 100
+
+def _peak_rss_mb():
+  '''Peak RSS of this process so far. On Linux ru_maxrss survives exec
+  (a child would report the parent's peak), so VmHWM is used instead.'''
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) / 1024
+  except OSError:
+    pass
+  # ru_maxrss is in bytes on macOS.
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+
+def _use_plain_sessions():
+  '''The mock server needs no auth; swap out the Google-authorized
+  session for the duration of the benchmark process.'''
+  import requests
+  import aoulib.core as c
+  from aoulib.utils import tune_session
+  c.make_authed_session_obj = (
+    lambda spec, pool_size=None: tune_session(requests.Session(), pool_size))
+
+def _api_spec(base_url, page_size):
+  return {'base-url': base_url, 'awardee': 'NYC', 'path-to-key-file': None,
+          'page-size': page_size}
+
+def _partitions(workers):
+  from aoulib import fetch
+  if workers < 2:
+    return None
+  return fetch.org_partitions([org for org, _ in synth.ORGANIZATIONS])
+
+def _synth_pages(pool, size):
+  for start in range(0, size, PAGE_SIZE):
+    yield list(pool.records(min(PAGE_SIZE, size - start), start))
+
+def run_stage(args, pool=None):
+  '''Runs one stage in this process; returns (rows, seconds). The
+  transform stage draws its records from pool.'''
+  import aoulib.etl as etl
+  _use_plain_sessions()
+  api_spec = _api_spec(args.base_url, args.page_size)
+  if args.stage == 'transform':
+    begin_dt = etl.active_retention_date.window_start()
+    rows, secs = 0, 0.0
+    for page in _synth_pages(pool, args.size):
+      start = time.perf_counter()
+      rows += len(etl._transform_chunk(page, begin_dt,
+                                       args.transform_engine))
+      secs += time.perf_counter() - start
+    return rows, secs
+  start = time.perf_counter()
+  if args.stage == 'api2db':
+    with open(args.db_spec) as f:
+      db_spec = json.load(f)
+    etl.api2db(api_spec, db_spec, args.db_table, {},
+               batch_size=args.batch_size,
+               partitions=_partitions(args.fetch_workers),
+               max_workers=args.fetch_workers,
+               transform_engine=args.transform_engine,
+               fetch_engine=args.fetch_engine)
+    rows = args.size
+  else:
+    pages = etl._iter_api_pages(api_spec, {}, None,
+                                _partitions(args.fetch_workers),
+                                args.fetch_workers,
+                                engine=args.fetch_engine)
+    if args.stage == 'pipeline':
+      pages = etl._hp_pages(pages, engine=args.transform_engine)
+    rows = sum(len(page) for page in pages)
+  return rows, time.perf_counter() - start
+
+def _child(args):
+  pool = None
+  if args.stage == 'transform':
+    pool = synth.RecordPool(min(args.distinct, args.size)).fill()
+  base = _peak_rss_mb()
+  rows, secs = run_stage(args, pool)
+  print(json.dumps({'rows': rows, 'secs': secs,
+                    'base_mb': base, 'peak_mb': _peak_rss_mb()}))
+
+def _spawn(args, stage, size, base_url):
+  cmd = [sys.executable, __file__, '--child', '--stage', stage,
+         '--size', str(size), '--base-url', base_url,
+         '--fetch-workers', str(args.fetch_workers),
+         '--fetch-engine', args.fetch_engine,
+         '--transform-engine', args.transform_engine,
+         '--distinct', str(args.distinct),
+         '--batch-size', str(args.batch_size)]
+  if args.page_size:
+    cmd += ['--page-size', args.page_size]
+  if args.db_spec:
+    cmd += ['--db-spec', args.db_spec, '--db-table', args.db_table]
+  out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE,
+                       universal_newlines=True).stdout
+  return json.loads(out.strip().splitlines()[-1])
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--sizes', default='10000,100000,1000000')
+  parser.add_argument('--stages', default='fetch,transform,pipeline')
+  parser.add_argument('--latency', type=float, default=0.0,
+                      help='seconds the mock API adds to every response')
+  parser.add_argument('--fetch-workers', type=int, default=1,
+                      help='> 1 pages one partition per organization '
+                           'concurrently')
+  parser.add_argument('--fetch-engine', default='threads',
+                      choices=['threads', 'asyncio'])
+  parser.add_argument('--page-size',
+                      help='records per API page, or "adaptive" '
+                           '(default 100)')
+  parser.add_argument('--transform-engine', default='row',
+                      choices=['row', 'columnar'])
+  parser.add_argument('--distinct', type=int, default=20000,
+                      help='distinct synthetic records (see '
+                           'synth.RecordPool)')
+  parser.add_argument('--batch-size', type=int, default=5000,
+                      help='api2db batch_size')
+  parser.add_argument('--db-spec')
+  parser.add_argument('--db-table')
+  # Internal: run one stage and print its result as JSON.
+  parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+  parser.add_argument('--stage', help=argparse.SUPPRESS)
+  parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+  parser.add_argument('--base-url', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+  if args.child:
+    _child(args)
+    return
+  stages = args.stages.split(',')
+  for stage in stages:
+    if stage not in STAGES:
+      parser.error('unknown stage ' + stage)
+  if 'api2db' in stages and not (args.db_spec and args.db_table):
+    parser.error('api2db needs --db-spec and --db-table')
+  print('{:<10} {:>9} {:>9} {:>12} {:>9} {:>9}'.format(
+          'stage', 'rows', 'secs', 'rows/sec', 'base MB', 'peak MB'))
+  for size in [int(x) for x in args.sizes.split(',')]:
+    server = mockrdr.serve(size, latency=args.latency,
+                           distinct=args.distinct)
+    try:
+      for stage in stages:
+        r = _spawn(args, stage, size, server.base_url)
+        print('{:<10} {:>9,} {:>9.2f} {:>12,.0f} {:>9.0f} {:>9.0f}'.format(
+                stage, r['rows'], r['secs'], r['rows'] / r['secs'],
+                r['base_mb'], r['peak_mb']), flush=True)
+    finally:
+      server.shutdown()
+
+if __name__ == '__main__': main()
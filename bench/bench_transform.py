@@ -0,0 +1,97 @@
+import sys
+import os
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+import aoulib.transform as t
+import synth
+
+'''
+# bench_transform.py
+
+Times transform.into_hp_row against the original implementation, which
+resolved each mapping's converter by name (str2func) for every row, and
+against the column-wise engine (transform.into_hp_columns), run once per
+API page of 100 records as api2db streams them and once over the whole
+dataset. Checks that all of them produce identical rows.
+
+    python bench/bench_transform.py [nrows]
+
+nrows defaults to 100000. Date caches are cleared before each run.
+
+No API or database access is needed; rows come from synth.py.
+'''
+
+def into_hp_row_by_name(api_row):
+  '''The pre-compiled-plan version of into_hp_row, kept for comparison.'''
+  out = {}
+  for mapping in t.mappings_one_to_one:
+    api_val = api_row.get(mapping['api'], '')
+    if mapping.get('func', '*') != '*':
+      hp_val = t.str2func(mapping['func'])(api_val)
+    else:
+      hp_val = api_val
+    out[mapping['hp']] = hp_val
+  i = 0
+  while i < len(t.mappings_one_to_many):
+    status, time_ = t.api2hp_mult_sample_resolve(
+                      api_row,
+                      t.mappings_one_to_many[i]['api'],
+                      t.mappings_one_to_many[i + 1]['api'])
+    out[t.mappings_one_to_many[i]['hp']] = status
+    out[t.mappings_one_to_many[i + 1]['hp']] = time_
+    i += 2
+  sal = 'Saliva Sample Order Status'
+  if api_row.get('sampleOrderStatus1SAL2', '*') not in ('*', 'UNSET'):
+    out[sal] = api_row['sampleOrderStatus1SAL2']
+  else:
+    out[sal] = api_row.get('sampleOrderStatus1SAL', '')
+  out['Consent Cohort'] = t.determine_consent_cohort(api_row)
+  return out
+
+PAGE_SIZE = 100
+
+def clear_caches():
+  '''Start each timed run with cold date caches.'''
+  t._hp_date.cache_clear()
+  t._hp_datetime.cache_clear()
+  t._eastern_offset.cache_clear()
+
+def timeit(fn, rows):
+  clear_caches()
+  start = time.perf_counter()
+  out = [fn(r) for r in rows]
+  return time.perf_counter() - start, out
+
+def timeit_columns(rows, page_size):
+  clear_caches()
+  start = time.perf_counter()
+  out = []
+  for i in range(0, len(rows), page_size):
+    out.extend(t.columns_to_dicts(t.into_hp_columns(rows[i:i + page_size])))
+  return time.perf_counter() - start, out
+
+def check(out, expected, what):
+  assert out == expected, what + ' outputs differ'
+  assert all(list(a) == list(b) for a, b in zip(out, expected)), \
+         what + ' column order differs'
+
+def main():
+  n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  rows = list(synth.synth_records(n))
+  old_secs, old_out = timeit(into_hp_row_by_name, rows)
+  new_secs, new_out = timeit(t.into_hp_row, rows)
+  check(new_out, old_out, 'compiled')
+  page_secs, page_out = timeit_columns(rows, PAGE_SIZE)
+  check(page_out, new_out, 'columnar (pages)')
+  del page_out
+  all_secs, all_out = timeit_columns(rows, n)
+  check(all_out, new_out, 'columnar (dataset)')
+  print('rows: {}'.format(n))
+  for name, secs in [('by name', old_secs), ('compiled', new_secs),
+                     ('columnar, pages of {}'.format(PAGE_SIZE), page_secs),
+                     ('columnar, dataset', all_secs)]:
+    print('{:24} {:.3f}s  {:,.0f} rows/sec  {:.2f}x'.format(
+      name + ':', secs, n / secs, old_secs / secs))
+
+if __name__ == '__main__': main()
@@ -0,0 +1,188 @@
+import sys
+import os
+import gzip
+import json
+import time
+import argparse
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.insert(0, os.path.dirname(__file__))
+import synth
+
+'''
+# mockrdr.py
+
+Local stand-in for the RDR ParticipantSummary API, serving synth.py
+records in the same bundle/link paging format, for benchmarking fetch
+without network or credentials.
+
+    python bench/mockrdr.py --participants 100000 [--port 8000] [--latency 0.2]
+                            [--distinct 20000]
+
+Point an api spec's "base-url" at the printed URL (the "awardee" and
+"path-to-key-file" values are ignored) and use a plain requests.Session
+instead of core.make-authed-session-obj.
+
+Supported:
+  ParticipantSummary?awardee=..&count=..[&_token=..][&<field>=<value>..]
+      equality filters on any field; lastModified also takes lt/le/gt/ge
+      prefixes and may be given twice for a range.
+  ParticipantSummary/Modified?awardee=..
+  Participant/<participantId>/Summary
+
+Responses are gzipped if the request accepts gzip.
+
+Records come from a synth.RecordPool of --distinct records, generated at
+startup, so memory use doesn't grow with --participants. _token is the
+index to continue scanning from.
+'''
+
+DEFAULT_PAGE_SIZE = 100
+
+# Paging and auth params, not record filters.
+_RESERVED = {'awardee', 'count', '_token', '_sort', '_includeTotal'}
+
+def _compare(op, value, bound):
+  if op == 'lt': return value < bound
+  if op == 'le': return value <= bound
+  if op == 'gt': return value > bound
+  if op == 'ge': return value >= bound
+  return value == bound
+
+def _filters(query):
+  '''List of (field, op, value) from parsed query params.'''
+  out = []
+  for field, values in query.items():
+    if field in _RESERVED:
+      continue
+    for value in values:
+      op = 'eq'
+      if field == 'lastModified' and value[:2] in ('lt', 'le', 'gt', 'ge'):
+        op, value = value[:2], value[2:]
+      out.append((field, op, value))
+  return out
+
+def _matches(rcd, filters):
+  for field, op, value in filters:
+    x = rcd.get(field, '')
+    if field == 'lastModified':
+      # Compare at second precision, ignoring fraction/Z.
+      x = x[:19]
+    if not _compare(op, x, value):
+      return False
+  return True
+
+class MockRDR:
+  '''The dataset and paging logic, independent of HTTP.'''
+  def __init__(self, participants, seed=0, latency=0.0, distinct=20000):
+    self.participants = participants
+    self.pool = synth.RecordPool(min(distinct, participants) or 1, seed).fill()
+    self.latency = latency
+    self.requests = 0
+    self.lock = threading.Lock()
+
+  def page(self, base_url, query):
+    count = int(query.get('count', [DEFAULT_PAGE_SIZE])[0])
+    start = int(query.get('_token', ['0'])[0])
+    filters = _filters(query)
+    entry = []
+    i = start
+    while i < self.participants and len(entry) < count:
+      rcd = self.pool.record(i)
+      i += 1
+      if _matches(rcd, filters):
+        entry.append({'fullUrl': '{}Participant/{}/Summary'.format(
+                                   base_url, rcd['participantId']),
+                      'resource': rcd})
+    bundle = {'resourceType': 'Bundle', 'type': 'searchset', 'entry': entry}
+    if i < self.participants:
+      params = {k: v for k, v in query.items() if k != '_token'}
+      params['_token'] = [str(i)]
+      bundle['link'] = [{'relation': 'next',
+                         'url': '{}ParticipantSummary?{}'.format(
+                                  base_url,
+                                  urllib.parse.urlencode(params, doseq=True))}]
+    return bundle
+
+  def modified(self):
+    return [{'participantId': r['participantId'],
+             'lastModified': r['lastModified']}
+            for r in self.pool.records(self.participants)]
+
+  def summary(self, pid):
+    i = synth.participant_index(pid)
+    if not 0 <= i < self.participants:
+      return None
+    return self.pool.record(i)
+
+class _Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    rdr = self.server.rdr
+    with rdr.lock:
+      rdr.requests += 1
+    if rdr.latency:
+      time.sleep(rdr.latency)
+    url = urllib.parse.urlsplit(self.path)
+    query = urllib.parse.parse_qs(url.query)
+    parts = [p for p in url.path.split('/') if p]
+    base_url = 'http://{}:{}/'.format(*self.server.server_address[:2])
+    if parts == ['ParticipantSummary']:
+      body = rdr.page(base_url, query)
+    elif parts == ['ParticipantSummary', 'Modified']:
+      body = rdr.modified()
+    elif len(parts) == 3 and parts[0] == 'Participant' and parts[2] == 'Summary':
+      body = rdr.summary(parts[1])
+      if body is None:
+        return self._send(404, {'message': 'Not found'})
+    else:
+      return self._send(404, {'message': 'Not found'})
+    self._send(200, body)
+
+  def _send(self, status, body):
+    data = json.dumps(body).encode('utf-8')
+    self.send_response(status)
+    if 'gzip' in self.headers.get('Accept-Encoding', ''):
+      data = gzip.compress(data, compresslevel=1)
+      self.send_header('Content-Encoding', 'gzip')
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    pass
+
+def serve(participants, port=0, latency=0.0, seed=0, distinct=20000):
+  '''Starts the server on a background thread; returns the server, whose
+  .base_url is the value for an api spec's "base-url". Stop it with
+  .shutdown().'''
+  server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+  server.daemon_threads = True
+  server.rdr = MockRDR(participants, seed, latency, distinct)
+  server.base_url = 'http://{}:{}/'.format(*server.server_address[:2])
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--participants', type=int, default=10000)
+  parser.add_argument('--port', type=int, default=8000,
+                      help='0 picks a free port')
+  parser.add_argument('--latency', type=float, default=0.0,
+                      help='seconds added to every response')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--distinct', type=int, default=20000,
+                      help='distinct records before values repeat')
+  args = parser.parse_args()
+  server = serve(args.participants, args.port, args.latency, args.seed,
+                 args.distinct)
+  print(server.base_url, flush=True)
+  try:
+    threading.Event().wait()
+  except KeyboardInterrupt:
+    server.shutdown()
+
+if __name__ == '__main__': main()
@@ -0,0 +1,251 @@
+import sys
+import os
+import bisect
+import random
+import datetime
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import aoulib.transform as t
+
+'''
+# synth.py
+
+Synthetic ParticipantSummary records for the benchmarks: every API field
+read by transform.mappings_one_to_one and mappings_one_to_many, with
+enum values drawn in rough real-world proportions and timestamps in the
+shapes RDR sends.
+
+Record i is the same for a given seed no matter how many are made or in
+what order, so mockrdr.py can serve any page without keeping the whole
+dataset in memory.
+
+    python bench/synth.py [n] > records.jsonl
+'''
+
+ORGANIZATIONS = [('COLUMBIA_WEILL', 6), ('NYU_GENERAL', 3), ('HARLEM_HEALTH', 1)]
+SITES = [('hpo-site-columbia', 5), ('hpo-site-weillcornell', 3),
+         ('hpo-site-nyuhospital', 2), ('UNSET', 1)]
+
+# Weighted values by API field; fields not listed here are drawn by
+# converter from CONVERTER_VALUES.
+FIELD_VALUES = {
+  'sex': [('SexAtBirth_Female', 55), ('SexAtBirth_Male', 40),
+          ('SexAtBirth_Intersex', 1), ('PMI_Skip', 2),
+          ('PMI_PreferNotToAnswer', 2)],
+  'genderIdentity': [('GenderIdentity_Woman', 54), ('GenderIdentity_Man', 40),
+                     ('GenderIdentity_NonBinary', 2),
+                     ('GenderIdentity_Transgender', 1),
+                     ('GenderIdentity_MoreThanOne', 1), ('PMI_Skip', 2)],
+  'race': [('WHITE', 30), ('BLACK_OR_AFRICAN_AMERICAN', 25),
+           ('HISPANIC_LATINO_OR_SPANISH', 20), ('ASIAN', 8),
+           ('HLS_AND_WHITE', 4), ('HLS_AND_BLACK', 3),
+           ('MORE_THAN_ONE_RACE', 3), ('OTHER_RACE', 2),
+           ('MIDDLE_EASTERN_OR_NORTH_AFRICAN', 1),
+           ('AMERICAN_INDIAN_OR_ALASKA_NATIVE', 1),
+           ('PMI_PreferNotToAnswer', 2), ('UNSET', 1)],
+  'education': [('HighestGrade_CollegeGraduate', 25),
+                ('HighestGrade_AdvancedDegree', 18),
+                ('HighestGrade_CollegeOnetoThree', 22),
+                ('HighestGrade_TwelveOrGED', 20),
+                ('HighestGrade_NineThroughEleven', 8),
+                ('HighestGrade_FiveThroughEight', 3), ('PMI_Skip', 4)],
+  'enrollmentStatus': [('FULL_PARTICIPANT', 60), ('MEMBER', 25),
+                       ('INTERESTED', 15)],
+  'language': [('SpokenWrittenLanguage_English', 75),
+               ('SpokenWrittenLanguage_Spanish', 20),
+               ('SpokenWrittenLanguage_ChineseChina', 3), ('UNSET', 2)],
+  'primaryLanguage': [('en', 78), ('es', 20), ('UNSET', 2)],
+  'withdrawalReason': [('UNSET', 97), ('PMI_Other', 3)],
+  'withdrawalStatus': [('NOT_WITHDRAWN', 97), ('NO_USE', 3)],
+  'state': [('PIIState_NY', 85), ('PIIState_NJ', 10), ('PIIState_CT', 4),
+            ('UNSET', 1)],
+  'retentionEligibleStatus': [('ELIGIBLE', 60), ('NOT_ELIGIBLE', 40)],
+  'retentionType': [('ACTIVE', 30), ('PASSIVE', 25),
+                    ('ACTIVE_AND_PASSIVE', 15), ('UNSET', 30)],
+  'consentCohort': [('COHORT_1', 20), ('COHORT_2', 45), ('COHORT_3', 35)],
+  'cohort2PilotFlag': [('UNSET', 90), ('COHORT_2_PILOT', 10)],
+  'income': [('AnnualIncome_10k25k', 20), ('AnnualIncome_25k35k', 15),
+             ('AnnualIncome_50k75k', 20), ('AnnualIncome_100k150k', 15),
+             ('PMI_Skip', 30)],
+}
+
+CONVERTER_VALUES = {
+  'api2hp_status': [('SUBMITTED', 70), ('SUBMITTED_NOT_SURE', 2),
+                    ('UNSET', 28)],
+  'api2hp_received': [('RECEIVED', 55), ('UNSET', 45)],
+  'api2hp_completed': [('COMPLETED', 70), ('UNSET', 30)],
+  'api2hp_site': SITES,
+  'api2hp_required_surveys_completed': [(3, 75), (2, 10), (1, 10), (0, 5)],
+  'api2hp_completed_or_0': [(n, 1) for n in range(0, 15)],
+  'api2hp_into_str': [('UNSET', 60), ('SUBMITTED', 30), ('COMPLETED', 10)],
+}
+
+# Fields RDR sends as a list, which is empty for most participants; see
+# synth_record.
+LIST_FIELDS = ['participantIncentives']
+
+# Status value that goes with a timestamp; see synth_record.
+STATUS_WITH_TIME = {'api2hp_status': 'SUBMITTED',
+                    'api2hp_received': 'RECEIVED',
+                    'api2hp_completed': 'COMPLETED'}
+
+ENROLLMENT_START = datetime.datetime(2018, 5, 6)
+ENROLLMENT_DAYS = 5 * 365
+
+def api_field_kinds():
+  '''Converter to draw sample values for, per API field. Some fields are
+  mapped more than once (e.g. as-is and as a datetime); the more specific
+  converter wins.'''
+  kinds = {}
+  for m in t.mappings_one_to_one:
+    func = m.get('func')
+    if kinds.get(m['api']) in (None, 'api2hp_basic', 'api2hp_into_str'):
+      kinds[m['api']] = func
+  for status, time_ in zip(t.mappings_one_to_many[0::2],
+                           t.mappings_one_to_many[1::2]):
+    kinds.update({f: 'api2hp_received' for f in status['api']})
+    kinds.update({f: 'api2hp_datetime' for f in time_['api']})
+  return kinds
+
+def _timestamp_partners(kinds):
+  '''Map of datetime field to the status field it records the time of,
+  e.g. consentForCABoRTime -> consentForCABoR.'''
+  out = {}
+  for field, func in kinds.items():
+    if func != 'api2hp_datetime':
+      continue
+    for suffix in ('Authored', 'Time', 'Date'):
+      base = field[:-len(suffix)]
+      if field.endswith(suffix) and base in kinds:
+        out[field] = base
+        break
+  return out
+
+_KINDS = api_field_kinds()
+_PARTNERS = _timestamp_partners(_KINDS)
+
+def _weighted(table):
+  values = [v for v, _ in table]
+  cum, total = [], 0
+  for _, w in table:
+    total += w
+    cum.append(total)
+  return values, cum
+
+_FIELD_CHOICES = {f: _weighted(tbl) for f, tbl in FIELD_VALUES.items()}
+_CONVERTER_CHOICES = {f: _weighted(tbl) for f, tbl in CONVERTER_VALUES.items()}
+_ORG_CHOICES = _weighted(ORGANIZATIONS)
+
+def _choose(rnd, choices):
+  values, cum = choices
+  return values[bisect.bisect(cum, rnd.random() * cum[-1])]
+
+def format_timestamp(rnd, dt):
+  '''Mostly 'YYYY-MM-DDThh:mm:ss', like RDR; some with microseconds or a
+  trailing Z, which RDR also sends.'''
+  x = dt.strftime('%Y-%m-%dT%H:%M:%S')
+  r = rnd.random()
+  if r < 0.08:
+    return x + '.{:06d}'.format(rnd.randrange(1000000))
+  if r < 0.12:
+    return x + 'Z'
+  return x
+
+def synth_record(i, seed=0):
+  '''The i-th synthetic ParticipantSummary resource.'''
+  rnd = random.Random(seed * 1000003 + i)
+  enrolled = ENROLLMENT_START + datetime.timedelta(
+               days=rnd.randrange(ENROLLMENT_DAYS))
+  # Timestamps fall on quarter hours, so that (as with real data) many
+  # participants share them and the transform's date caches get hits.
+  def after(max_days):
+    return enrolled + datetime.timedelta(days=rnd.randrange(max_days),
+                                         minutes=rnd.randrange(0, 1440, 15))
+  rcd = {}
+  for field, func in _KINDS.items():
+    if field in _FIELD_CHOICES:
+      rcd[field] = _choose(rnd, _FIELD_CHOICES[field])
+    elif func in _CONVERTER_CHOICES:
+      rcd[field] = _choose(rnd, _CONVERTER_CHOICES[func])
+    elif func == 'api2hp_date':
+      rcd[field] = '{:04d}-{:02d}-{:02d}'.format(
+                     rnd.randint(1935, 2003), rnd.randint(1, 12),
+                     rnd.randint(1, 28))
+    elif func != 'api2hp_datetime':
+      rcd[field] = 'x' + str(rnd.randrange(1000))
+  for field, func in _KINDS.items():
+    if func != 'api2hp_datetime':
+      continue
+    partner = _PARTNERS.get(field)
+    if partner is not None:
+      has_time = rcd[partner] == STATUS_WITH_TIME.get(_KINDS[partner])
+    else:
+      has_time = rnd.random() < 0.6
+    if has_time:
+      rcd[field] = format_timestamp(rnd, after(900))
+    elif rnd.random() < 0.5:
+      # RDR leaves unset timestamps out altogether as often as not.
+      rcd[field] = ''
+  for field in LIST_FIELDS:
+    if not rcd.get(field):
+      rcd[field] = []
+  for field in ('consentCohort', 'cohort2PilotFlag', 'retentionEligibleStatus'):
+    rcd[field] = _choose(rnd, _FIELD_CHOICES[field])
+  rcd['organization'] = _choose(rnd, _ORG_CHOICES)
+  rcd['awardee'] = 'NYC'
+  rcd['zipCode'] = '1{:04d}'.format(rnd.randrange(10000))
+  rcd['lastModified'] = format_timestamp(rnd, after(1200))
+  return _identify(rcd, i)
+
+def _identify(rcd, i):
+  rcd['participantId'] = 'P' + str(100000000 + i)
+  rcd['biobankId'] = 'A' + str(200000000 + i)
+  rcd['firstName'] = 'First' + str(i)
+  rcd['lastName'] = 'Last' + str(i)
+  rcd['email'] = 'p{}@example.com'.format(i)
+  return rcd
+
+def participant_index(pid):
+  '''Inverse of the participantId given to record i.'''
+  return int(pid.lstrip('P')) - 100000000
+
+def synth_records(n, seed=0, start=0):
+  '''Generator; records start .. start+n-1.'''
+  for i in range(start, start + n):
+    yield synth_record(i, seed)
+
+class RecordPool:
+  '''
+  Cheap records for large runs: record i is a copy of synth_record(i %
+  distinct) with record i's identifiers, so only `distinct` records are
+  ever generated (synth_record manages a few thousand a second). Values
+  repeat every `distinct` records, which flatters the transform's date
+  caches once distinct is well below their size (65536).
+  '''
+  def __init__(self, distinct=20000, seed=0):
+    self.distinct = distinct
+    self.seed = seed
+    self.templates = [None] * distinct
+
+  def fill(self):
+    '''Generates all the records up front.'''
+    for j in range(self.distinct):
+      self.record(j)
+    return self
+
+  def record(self, i):
+    j = i % self.distinct
+    if self.templates[j] is None:
+      self.templates[j] = synth_record(j, self.seed)
+    return _identify(dict(self.templates[j]), i)
+
+  def records(self, n, start=0):
+    for i in range(start, start + n):
+      yield self.record(i)
+
+def main():
+  import json
+  n = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+  for rcd in synth_records(n):
+    print(json.dumps(rcd))
+
+if __name__ == '__main__': main()
@@ -7,3 +7,8 @@ else
 fi
 pip install -r requirements.txt --upgrade --upgrade-strategy eager
 
+# Compile aoulib ahead of time, core.hy included (Hy caches its bytecode
+# in __pycache__ like Python does), so the first cron run doesn't pay for
+# compiling it. Stale bytecode is recompiled on import, as usual.
+python -m compileall -q aoulib
+python -c 'import aoulib.core'
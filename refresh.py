@@ -1,9 +1,13 @@
 import argparse
+import asyncio
+import collections
 import json
+import os
+import logging
+import threading
 import traceback
 import aoulib as aou
 import aoulib.db as s
-from aoulib.db import AgentJobException
 from aoulib.utils import *
 
 import sys
@@ -63,6 +67,9 @@ Create  `enclave/aou-api-spec.json` with these contents:
 
 _Note:_ please confirm the URL and project, but the one above will most likely be what you'll use.
 
+Optionally, add "request-timeout": the seconds (default 300) an API
+request may take before it fails and is retried (see "fetch-retries").
+
 #### Database specification file
 
 Create a file named `enclave/db-spec.json` inside `enclave` with the contents:
@@ -93,7 +100,24 @@ enclave/site-config.json with the following key-value pairs:
      "should-run-agent-job": true,
      "agent-job-name": "DM_AOU REDCap Refresh Decoupled",
      "agent-job-table-name": "rc_prj_2525",
-     "agent-job-timeout": 20000}
+     "agent-job-timeout": 20000,
+     "insert-batch-size": 5000,
+     "fetch-partitions": null,
+     "fetch-workers": 4,
+     "fetch-engine": "threads",
+     "page-size": 100,
+     "refresh-mode": "full",
+     "incremental-state-file": "enclave/state-healthpro2.json",
+     "load-method": "executemany",
+     "load-batch-size": 10000,
+     "transform-workers": 0,
+     "transform-chunk-size": 500,
+     "transform-engine": "row",
+     "load-mode": "direct",
+     "page-cache-dir": null,
+     "page-cache-keep": 3,
+     "fetch-retries": 5,
+     "metrics-textfile": null}
 
 - Set should-send-emails to false (no quotes) to skip this.
 
@@ -103,7 +127,10 @@ to null (no quotes) if no filtering is needed.
 
 - You can optionally run a SQL Server agent job afterward. Configure the 
 last three items as desired. Set should-run-agent-job to false (no quotes)
-to skip this.
+to skip this. Each job is started as soon as its table has loaded (a job
+shared by several site configs, once all of their tables have), so it
+runs while any other tables are still loading; refresh.py waits for all
+of them at the end.
 
 - If you want to keep a record of when data is updated, set "should-update-metadata" to
 true (no quotes) and create a table in your database like so:
@@ -120,6 +147,96 @@ true (no quotes) and create a table in your database like so:
 - "agent-job-table-name" is solely for recording the datetime in
 the metadata table after the agent job runs.
 
+- "insert-batch-size" is optional. If set, API pages are transformed and
+inserted as they arrive, this many rows at a time, instead of holding the
+whole dataset in memory first. Leave it out (or set to null) for the
+original fetch-everything-then-load behavior.
+
+- "fetch-partitions" is optional. Set it to a list of query-param maps,
+e.g. [{"organization": "COLUMBIA_WEILL"}, {"organization": "HARLEM_HOSPITAL"}],
+to page through each as an independent stream, "fetch-workers" (default 4)
+at a time; results are merged and de-duplicated by participantId.
+Each partition is combined with paired-organization-params, so it may not
+set any of the same params (e.g. partition by organization only when
+paired-organization-params has no "organization").
+
+- "fetch-engine" is optional. "threads" (the default) pages each stream
+on its own thread. "asyncio" pages every stream from one thread over a
+shared connection pool, "fetch-workers" requests at a time, which scales
+better to many partitions; it needs aiohttp (pip install aiohttp).
+
+- Installing orjson (pip install orjson) roughly halves the time spent
+decoding API pages; nothing needs configuring.
+
+- "page-size" is optional: how many participants to ask the API for per
+page (default 100). Bigger pages mean fewer round trips. Set it to
+"adaptive" to start at 100 and keep doubling it (up to 1000) for as long
+as pages come back within 5 seconds. Either way, each response's size,
+on the wire and decompressed, is logged.
+
+- "refresh-mode" is optional; "full" (the default) drops and reloads the
+table each run. "incremental" finds the participants whose lastModified
+changed since the last run (per ParticipantSummary/Modified), fetches
+those modified since the earliest of these changes with
+paired-organization-params, and merges them into the table, deleting
+rows that are no longer returned for those params (the table gets an
+index on [PMI ID], "ix_pmi_id", for this). The lastModified values seen are kept in "incremental-state-file" (use one
+file per db-table-name). The first incremental run, or a run where the
+table is missing, does a full load. Delete the state file to force a full
+reload.
+
+- "load-method" is optional; "executemany" (the default) inserts row by
+row with parameterized INSERTs. "batched" sends multi-row INSERT
+statements (about 12 rows each, the most the 2100-parameter limit allows)
+inside one transaction; "load-batch-size" can lower the rows per
+statement. "bulk" uses the TDS bulk-load protocol
+(column types taken from sql/create-table.sql) with TABLOCK, sending
+"load-batch-size" rows per batch; the login needs permission for bulk
+loads into the table. Switch back to "executemany" if bulk loads aren't
+allowed on your server.
+
+- "transform-workers" is optional. Above 1, the HealthPro transform and
+Active Retention Date calculation run on that many processes,
+"transform-chunk-size" participants per task. 0 (the default) runs them
+serially, which is easiest to debug. "transform-engine" is optional too:
+"row" (the default) converts one participant at a time, "columnar" a whole
+page (or task) column by column, which is faster; the rows are the same.
+
+- "load-mode" is optional. "direct" (the default) drops the table and
+reloads it in place, so it is missing or partly filled while the load
+runs. "swap" loads a staging table (db-table-name + "_stage") instead,
+runs sql/create-indexes.sql against it if that file exists (same
+$TABLE_NAME$ placeholder as sql/create-table.sql), updates its
+statistics, and then swaps it in with sp_rename in one short
+transaction. The replaced table is kept as db-table-name + "_prev";
+run refresh.py with --rollback to swap it back. A failed swap load
+leaves the live table as it was. Pairs well with "load-method": "bulk".
+
+- "page-cache-dir" is optional. If set, every raw ParticipantSummary page
+fetched is also saved there (gzipped JSON lines plus a manifest, one
+folder per run), and only the newest "page-cache-keep" (default 3) runs
+are kept. Run refresh.py with --replay <run> (a folder name, or "latest")
+to rebuild the table(s) from a cached run without calling the API, e.g.
+after a database failure. Replays are always full loads. A run cut
+short by --maxrows is marked truncated: "latest" skips it and it
+doesn't count toward "page-cache-keep", but it can be replayed by name.
+The cache also records how far each fetch got: if a fetch fails part
+way, the next run (within 12 hours, with the same API settings) resumes
+it from there instead of starting over.
+
+- "fetch-retries" (default 5) is how many times a failed API page
+request (connection errors, timeouts, HTTP 429 and 5xx) is retried, with
+randomized exponential backoff, before the run fails.
+
+- "metrics-textfile" is optional. Each run's timings are logged as one
+JSON record ("Run metrics: ...") and also stored in the "details" column
+of the metadata rows: wall time, rows, bytes received, rows/sec and peak
+memory for each stage (auth, fetch, transform, retention, ddl, load,
+agent_job); see aoulib/metrics.py. If "metrics-textfile" is a path
+(e.g. /var/lib/node_exporter/textfile/aou_refresh.prom), the same figures
+are written there in Prometheus format after every run, successful or
+not, for node_exporter's textfile collector.
+
 ### Actually running refresh.py 
 
 Example:
@@ -127,6 +244,21 @@ Example:
     source venv/bin/activate
     python refresh.py --site-config enclave/site-config.json --aou-api-spec enclave/aou-api-spec.json --db-spec enclave/p03.json
 
+To refresh several tables (e.g. one per paired organization) from a
+single fetch, pass --site-config once per site config. Participants are
+fetched and transformed once: when paired-organization-params only set
+"awardee" (the API spec's), "organization" or "site" to a single value,
+the awardee's participants are paged through once and each table gets
+those whose fields match its params. Any other paired-organization-params
+are paged through as a stream of their own, and that table gets what the
+API returned for them. The tables are loaded concurrently. A run replayed
+with --replay must have been fetched with the same site configs.
+Fetch and transform settings come from the first site config;
+"refresh-mode" must be "full" for all of them, and "insert-batch-size"
+is not used.
+
+    python refresh.py --site-config enclave/site-config-columbia.json --site-config enclave/site-config-harlem.json --aou-api-spec enclave/aou-api-spec.json --db-spec enclave/p03.json
+
 ... or, just use the provided shell script: ...
 
   ./runrefresh.sh    
@@ -134,7 +266,18 @@ Example:
 Note: if you wish to conduct a test, you can specify a value for maxrows
 (the program doesn't honor the value exactly but will be close). This way,
 you can test your pipeline and configuration without waiting for an entire dataset
-to load/process.
+to load/process. maxrows can't be combined with "refresh-mode"
+"incremental".
+
+To see where a run spends its time or memory, add --profile cpu (a
+cProfile of each stage: fetch, transform, retention, ddl, load, ...) or
+--profile mem (tracemalloc snapshots after the fetch, transform and
+load). The results are written to the log folder as
+refresh-profile-<time>-cpu.txt (plus a .pstats file per stage) or
+refresh-profile-<time>-mem.txt. Profiling slows the run down, so
+combine it with --maxrows for a quick sample:
+
+    python refresh.py --site-config enclave/site-config.json --aou-api-spec enclave/aou-api-spec.json --db-spec enclave/p03.json --maxrows 5000 --profile cpu
 
 ### Setting up as cron job
 
@@ -148,6 +291,11 @@ environment.
 
 log = smart_logger('refresh')
 
+# aoulib's own log lines (e.g. one per API response, from aoulib.fetch)
+# go to the same file.
+logging.getLogger('aoulib').addHandler(log.handlers[0])
+logging.getLogger('aoulib').setLevel(logging.INFO)
+
 
 # email footer
 emfooter = '''\n\n
@@ -162,22 +310,185 @@ https://nexus.weill.cornell.edu/pages/viewpage.action?pageId=111677100 '''
 
 #-------------------------------------------------------------------------------
 
-def update_metadata_for(db_spec, cfg, table_name):
+def update_metadata_for(db_spec, cfg, table_name, details='refreshed'):
   # Get table name without db or schema portions, etc.
   tbl = table_name[table_name.rfind('.')+1:].replace('[','').replace(']','')
   # We're just inserting one row; but we use db_insert_many for convenience.
   s.db_insert_many(db_spec, cfg['metadata-table-name'],
-                   [{'tag': tbl, 'details': 'refreshed'}])
+                   [{'tag': tbl, 'details': details}])
   log.info('Inserted new row into metadata table.')
 
+def etl_options(cfg):
+  '''Keyword arguments for aou.etl.api2db from a site config.'''
+  return dict(batch_size=cfg.get('insert-batch-size'),
+              partitions=cfg.get('fetch-partitions'),
+              max_workers=cfg.get('fetch-workers', 4),
+              load_method=cfg.get('load-method', s.EXECUTEMANY),
+              load_batch_size=cfg.get('load-batch-size'),
+              transform_workers=cfg.get('transform-workers', 0),
+              transform_chunk_size=cfg.get('transform-chunk-size', 500),
+              transform_engine=cfg.get('transform-engine',
+                                       aou.etl.ROW_ENGINE),
+              load_mode=cfg.get('load-mode', aou.etl.DIRECT_LOAD),
+              cache_dir=cfg.get('page-cache-dir'),
+              fetch_retries=cfg.get('fetch-retries',
+                                    aou.etl.FETCH_RETRIES),
+              fetch_engine=cfg.get('fetch-engine', aou.etl.THREAD_FETCH),
+              page_size=cfg.get('page-size'))
+
+def prune_page_cache(cfg):
+  if cfg.get('page-cache-dir'):
+    aou.pagecache.prune_runs(cfg['page-cache-dir'],
+                             cfg.get('page-cache-keep', 3))
+
+def email_for(cfg, status, text):
+  if cfg['should-send-emails']:
+    send_email(
+      frm=cfg['from-email'],
+      to=cfg['to-email'],
+      subj='AoU Data Refresh - ' + status + ' - ' + today_as_str(),
+      body=('HealthPro table for this run: ' + cfg['db-table-name'] + '\n\n' 
+            + text + emfooter))
+
+def load_one(cfg, api_spec, db_spec, maxrows, jobs, replay=None):
+  '''Loads cfg's table, then starts its agent job into jobs (see
+  start_agent_job).'''
+  opts = etl_options(cfg)
+  if not replay and cfg.get('refresh-mode', 'full') == 'incremental':
+    result = aou.etl.api2db_incremental(
+               api_spec, db_spec, cfg['db-table-name'],
+               cfg['paired-organization-params'],
+               cfg['incremental-state-file'],
+               maxrows=maxrows, **opts)
+    log.info('Incremental refresh result: ' + str(result))
+  else:
+    aou.etl.api2db(api_spec, db_spec, cfg['db-table-name'],
+                   cfg['paired-organization-params'], maxrows,
+                   replay=replay, **opts)
+  start_agent_job(cfg, db_spec, jobs)
+  prune_page_cache(cfg)
+
+def load_many(cfgs, api_spec, db_spec, maxrows, jobs, replay=None):
+  '''One fetch and transform for several site configs; see
+  aou.etl.api2db_multi. Fetch/transform settings come from the first.
+  Each agent job is started into jobs once the tables of all the site
+  configs that run it have loaded.'''
+  if (not replay
+      and any(cfg.get('refresh-mode', 'full') != 'full' for cfg in cfgs)):
+    raise Exception('refresh-mode "incremental" needs its own refresh.py run.')
+  opts = etl_options(cfgs[0])
+  if opts.pop('batch_size'):
+    log.info('insert-batch-size is ignored with several site configs.')
+  targets = [{'db_table_name': cfg['db-table-name'],
+              'custom_params': cfg['paired-organization-params'],
+              'load_method': cfg.get('load-method', s.EXECUTEMANY),
+              'load_batch_size': cfg.get('load-batch-size'),
+              'load_mode': cfg.get('load-mode', aou.etl.DIRECT_LOAD)}
+             for cfg in cfgs]
+  by_table = {cfg['db-table-name']: cfg for cfg in cfgs}
+  waiting = collections.Counter(cfg['agent-job-name'] for cfg in cfgs
+                                if cfg['should-run-agent-job'])
+  lock = threading.Lock()
+
+  def on_loaded(db_table_name):
+    cfg = by_table[db_table_name]
+    if not cfg['should-run-agent-job']:
+      return
+    with lock:
+      waiting[cfg['agent-job-name']] -= 1
+      if not waiting[cfg['agent-job-name']]:
+        start_agent_job(cfg, db_spec, jobs)
+
+  counts = aou.etl.api2db_multi(api_spec, db_spec, targets, maxrows,
+                                replay=replay, on_loaded=on_loaded, **opts)
+  log.info('Rows loaded per table: ' + str(counts))
+  prune_page_cache(cfgs[0])
+
+def start_agent_job(cfg, db_spec, jobs):
+  '''
+  Starts cfg's agent job, if it has one not already in jobs, without
+  waiting. jobs maps job name to its s.AgentJobRun, or to the exception
+  raised trying to start it.
+  '''
+  if not cfg['should-run-agent-job']:
+    return
+  agent_job_name = cfg['agent-job-name']
+  if agent_job_name in jobs:
+    return
+  print('Starting agent job: {}'.format(agent_job_name))
+  log.info('Starting agent job: {}'.format(agent_job_name))
+  try:
+    jobs[agent_job_name] = s.start_agent_job(db_spec, agent_job_name,
+                                             cfg['agent-job-timeout'])
+  except Exception as ex:
+    jobs[agent_job_name] = ex
+
+async def _gather(runs):
+  return await asyncio.gather(*runs, return_exceptions=True)
+
+def wait_for_agent_jobs(jobs):
+  '''Waits for all the runs from start_agent_job at once. Returns a map
+  of job name to True, or to the exception it failed with.'''
+  running = {name: run for name, run in jobs.items()
+             if not isinstance(run, Exception)}
+  outcomes = dict(jobs)
+  if running:
+    outcomes.update(zip(running, asyncio.run(_gather(running.values()))))
+  return outcomes
+
+def report_agent_job(cfg, db_spec, outcomes, run):
+  '''Step (3) for one site config. Returns False if its job failed.'''
+  if not cfg['should-run-agent-job']:
+    log.info('Won\'t run agent job.')
+    return True
+  outcome = outcomes[cfg['agent-job-name']]
+  if outcome is True:
+    print('Agent job ran OK.') 
+    log.info('Agent job ran OK.') 
+    if cfg['should-update-metadata']:
+      update_metadata_for(db_spec, cfg, cfg['agent-job-table-name'],
+                          run.to_json())
+    return True
+  log.error(str(outcome) + '\n' + ''.join(traceback.format_exception(
+    type(outcome), outcome, outcome.__traceback__)))
+  email_for(cfg, 'Error',
+            type(outcome).__name__ + ' occurred. ' + '\n\n' + str(outcome))
+  return False
+
+def report_metrics(cfgs, run, success):
+  run.finish()
+  log.info('Run metrics: ' + run.to_json())
+  path = cfgs[0].get('metrics-textfile') if cfgs else None
+  if path:
+    try:
+      aou.metrics.write_textfile(run, path, success)
+    except Exception:
+      log.error('Could not write metrics textfile:\n'
+                + traceback.format_exc())
+
+def write_profile(profiler):
+  '''Writes the --profile output next to this script's log files.'''
+  try:
+    out_dir = os.path.dirname(log.handlers[0].baseFilename)
+    path = profiler.write(out_dir, 'refresh-profile')
+    print('Profile written to ' + path)
+    log.info('Profile written to ' + path)
+  except Exception:
+    log.error('Could not write profile:\n' + traceback.format_exc())
+
 def main():
   # (1) Process any command-line options.
   log.info('========== refresh.py started ============')
+  cfgs = []
+  run = None
+  profiler = None
   try:
     p = argparse.ArgumentParser()
     p.add_argument('--site-config',
                    required=True,
-                   help='Path to a site-config file (see docs in refresh.py).')
+                   action='append',
+                   help='Path to a site-config file (see docs in refresh.py). '\
+                        'Repeat to refresh several tables from one fetch.')
     p.add_argument('--aou-api-spec',
                    required=True,
                    help='Path to a custom aou-api-spec JSON file.')
@@ -189,15 +500,26 @@ def main():
                    default=None,
                    help='Maximum amount of rows you wish to retrieve (approx).'\
                         'Useful for testing your setup/configuration.')
+    p.add_argument('--replay',
+                   default=None,
+                   metavar='RUN',
+                   help='Load from this run in the page cache (see '\
+                        'page-cache-dir), or "latest", instead of the API.')
+    p.add_argument('--profile',
+                   choices=aou.profiling.MODES,
+                   default=None,
+                   help='Profile the run: "cpu" (cProfile per stage) or '\
+                        '"mem" (tracemalloc after fetch, transform and '\
+                        'load); output goes to the log folder.')
+    p.add_argument('--rollback',
+                   action='store_true',
+                   help='Swap the previous generation of the table (kept by '\
+                        'load-mode "swap") back in, then exit.')
     args = p.parse_args()
 
-    cfg = slurpj(args.site_config)
-    log.info('site config filename: ' + args.site_config)
-    PAIRED_ORGANIZATION_PARAM = cfg['paired-organization-params']
-    DB_TABLE_NAME = cfg['db-table-name']
-    SHOULD_RUN_AGENT_JOB = cfg['should-run-agent-job']
-    AGENT_JOB_NAME = cfg['agent-job-name']
-    AGENT_JOB_TIMEOUT = cfg['agent-job-timeout']
+    for fname in args.site_config:
+      log.info('site config filename: ' + fname)
+      cfgs.append(slurpj(fname))
     
     api_spec_fname = args.aou_api_spec
     log.info('api spec filename: ' + api_spec_fname)
@@ -208,61 +530,68 @@ def main():
     db_spec = slurpj(db_spec_fname)
 
     maxrows = args.maxrows
+    replay = args.replay
+    if replay and not cfgs[0].get('page-cache-dir'):
+      raise Exception('--replay needs "page-cache-dir" in the site config.')
+
+    if args.rollback:
+      for cfg in cfgs:
+        aou.etl.rollback_swap(db_spec, cfg['db-table-name'])
+        print('Rolled back ' + cfg['db-table-name'])
+        log.info('Rolled back ' + cfg['db-table-name'])
+      return
 
     # (2) Ok, let's do the actual ETL process.
     print('Starting api2db.')
     log.info('Starting api2db.')
-    result = aou.etl.api2db(api_spec, db_spec, DB_TABLE_NAME, 
-                            PAIRED_ORGANIZATION_PARAM, maxrows)
+    if replay:
+      log.info('Replaying page cache run: ' + replay)
+    if args.profile:
+      profiler = aou.profiling.make_profiler(args.profile)
+    run = aou.metrics.RunMetrics(observers=[profiler] if profiler else [])
+    jobs = {}
+    with aou.metrics.recording(run):
+      if len(cfgs) == 1:
+        load_one(cfgs[0], api_spec, db_spec, maxrows, jobs, replay)
+      else:
+        load_many(cfgs, api_spec, db_spec, maxrows, jobs, replay)
+    if profiler:
+      # Only the ETL is profiled, not the agent jobs.
+      run.observers.remove(profiler)
+      profiler.stop()
     print('api2db ran OK.')
     log.info('api2db ran OK.')
-    if cfg['should-update-metadata']:
-      update_metadata_for(db_spec, cfg, DB_TABLE_NAME)
-
-    # (3) Optionally, run an agent job afterward.
-    if SHOULD_RUN_AGENT_JOB:
-      try:
-        print('Starting agent job: {}'.format(AGENT_JOB_NAME))
-        log.info('Starting agent job: {}'.format(AGENT_JOB_NAME))
-        s.db_run_agent_job(db_spec, AGENT_JOB_NAME, AGENT_JOB_TIMEOUT)
-        print('Agent job ran OK.') 
-        log.info('Agent job ran OK.') 
-        if cfg['should-update-metadata']:
-          update_metadata_for(db_spec, cfg, cfg['agent-job-table-name'])
-      except AgentJobException as ex:
-        log.error(str(ex) + '\n' +  traceback.format_exc())
-        if cfg['should-send-emails']:
-          send_email(
-            frm=cfg['from-email'],
-            to=cfg['to-email'],
-            subj='AoU Data Refresh - Error - ' + today_as_str(),
-            body=('HealthPro table for this run: ' + DB_TABLE_NAME + '\n\n' 
-                  + 'AgentJobException occurred. ' + '\n\n' + str(ex)
-                  + emfooter))
-        # Bail.
-        return
-    else:
-      log.info('Won\'t run agent job.')
+    for cfg in cfgs:
+      if cfg['should-update-metadata']:
+        update_metadata_for(db_spec, cfg, cfg['db-table-name'],
+                            run.to_json())
+
+    # (3) Optionally, agent jobs; each was started as soon as its
+    # table(s) loaded, and all outcomes are collected here.
+    with aou.metrics.recording(run), aou.metrics.stage(aou.metrics.AGENT_JOB):
+      outcomes = wait_for_agent_jobs(jobs)
+    ok = True
+    for cfg in cfgs:
+      if report_agent_job(cfg, db_spec, outcomes, run):
+        email_for(cfg, 'Success', 'AoU data refresh success!')
+      else:
+        ok = False
+    report_metrics(cfgs, run, ok)
+    if profiler:
+      write_profile(profiler)
     print('Done!')
     log.info('Done!')
-    if cfg['should-send-emails']:
-      send_email(
-        frm=cfg['from-email'],
-        to=cfg['to-email'],
-        subj='AoU Data Refresh - Success - ' + today_as_str(),
-        body=('HealthPro table for this run: ' + DB_TABLE_NAME + '\n\n' 
-              + 'AoU data refresh success!' + emfooter))
   except Exception as ex:
       print(traceback.format_exc())
       log.error(traceback.format_exc())
-      if cfg['should-send-emails']:
-        send_email(
-          frm=cfg['from-email'],
-          to=cfg['to-email'],
-          subj='AoU Data Refresh - Error - ' + today_as_str(),
-          body=('HealthPro table for this run: ' + DB_TABLE_NAME + '\n\n' 
-                + 'There was an issue during the AoU data refresh. '
-                + 'Please check the log.' + emfooter))
+      if run:
+        report_metrics(cfgs, run, False)
+      if profiler:
+        write_profile(profiler)
+      for cfg in cfgs:
+        email_for(cfg, 'Error',
+                  'There was an issue during the AoU data refresh. '
+                  + 'Please check the log.')
   print('Exiting.')
   log.info('Exiting.')
 
@@ -24,6 +24,9 @@ def read_requirements():
 
 setup(name=LIBNAME,
       packages=find_packages(),
+      # core.hy and iam.v1.json aren't .py files, so they have to be
+      # listed to be installed.
+      package_data={LIBNAME: ['*.hy', '*.json']},
       install_requires=read_requirements(),
       zip_safe=False)
 